@@ -0,0 +1,359 @@
+"""
+Micro-benchmarks for the Spyglass pipeline.
+
+Run with `uv run bench.py <benchmark> [options]`, e.g.
+
+    uv run bench.py parse --path /path/to/protocol-v2/programs
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from typing import List, Optional
+
+import git
+import numpy as np
+
+import mock_openai
+from main import (
+    AnalysisBackend, OpenAIBackend, ReplayBackend, RustFunction, RustParser, SolanaAnalyzer, VectorIndex,
+    print_analysis_stats, process_files,
+)
+
+DRIFT_REPO_URL = "https://github.com/drift-labs/protocol-v2.git"
+DRIFT_COMMIT = "e2191dfc09cc1783618238b1cd22a7015b3085a6"
+
+
+def find_rust_files(path: str) -> List[str]:
+    rust_files = []
+    for root, _, files in os.walk(path):
+        rust_files.extend(os.path.join(root, file) for file in files if file.endswith('.rs'))
+    return sorted(rust_files)
+
+
+def report(label: str, elapsed: float, files: int, functions: int):
+    per_file_us = elapsed / max(files, 1) * 1e6
+    print(f"{label:<28} {elapsed:8.3f}s  {per_file_us:10.1f}us/file  {functions} functions")
+
+
+def bench_parse(path: str, rounds: int):
+    """
+    Per-file parse overhead with and without the precompiled query registry.
+
+    Both cases reuse one RustParser, so parser construction isn't measured.
+    "cold" clears its compiled queries before every file, so the function
+    query is compiled once per file like parse_file used to do. "warm" keeps
+    them, so the query is compiled once for the whole run.
+    """
+    rust_files = find_rust_files(path)
+    print(f"Benchmarking {len(rust_files)} Rust files under {path} ({rounds} rounds)")
+
+    cold_time = 0.0
+    warm_time = 0.0
+    functions = 0
+    cold_parser = RustParser()
+    warm_parser = RustParser()
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for file_path in rust_files:
+            cold_parser.queries.clear()
+            cold_parser.parse_file(file_path)
+        cold_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        functions = 0
+        for file_path in rust_files:
+            functions += len(warm_parser.parse_file(file_path))
+        warm_time += time.perf_counter() - start
+
+    report("query compiled per file", cold_time / rounds, len(rust_files), functions)
+    report("query compiled once", warm_time / rounds, len(rust_files), functions)
+
+
+def write_synthetic_file(path: str, lines: int):
+    """Write a monolithic Anchor-style file: one documented handler every eight lines."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(lines // 8):
+            f.write(
+                f"/// Handler {i}\n"
+                f"pub fn handler_{i}(ctx: Context<Handler>, amount: u64) -> Result<()> {{\n"
+                f"    let state = &mut ctx.accounts.state;\n"
+                f"    state.total = state.total.checked_add(amount).unwrap();\n"
+                f"    msg!(\"handler {i}\");\n"
+                f"    Ok(())\n"
+                f"}}\n"
+                f"\n"
+            )
+
+
+def bench_lines(lines: int, rounds: int):
+    """
+    Line-number resolution on one large synthetic file.
+
+    Compares resolving lines by rescanning the file prefix for every function
+    (what parse_file used to do) against parse_file as it is now.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "monolith.rs")
+        write_synthetic_file(path, lines)
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        print(f"Benchmarking {content.count(chr(10))}-line synthetic file ({rounds} rounds)")
+
+        rust_parser = RustParser()
+        tree = rust_parser.parser.parse(bytes(content, 'utf8'))
+        nodes = rust_parser.query("function").captures(tree.root_node)["function"]
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for node in nodes:
+                content[:node.start_byte].count('\n')
+                content[:node.end_byte].count('\n')
+        rescan_time = (time.perf_counter() - start) / rounds
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            functions = rust_parser.parse_file(path)
+        parse_time = (time.perf_counter() - start) / rounds
+
+        print(f"{'prefix rescan (lines only)':<28} {rescan_time:8.3f}s  {len(nodes)} functions")
+        print(f"{'parse_file (everything)':<28} {parse_time:8.3f}s  {len(functions)} functions")
+
+
+def synthetic_functions(count: int) -> List[RustFunction]:
+    """Distinct functions that each need a model analysis."""
+    return [
+        RustFunction.from_text(
+            f"transfer_{i}",
+            f"pub fn transfer_{i}(ctx: Context<Transfer>, amount: u64) -> Result<()> {{\n"
+            f"    let seeds = &[b\"vault\".as_ref(), &[ctx.bumps.vault]];\n"
+            f"    token::transfer(ctx.accounts.transfer_ctx().with_signer(&[seeds]), amount + {i})\n"
+            f"}}",
+            i * 4 + 1, i * 4 + 4, [], f"Transfer number {i}",
+        )
+        for i in range(count)
+    ]
+
+
+def write_function_files(path: str, functions: List[RustFunction], files: int) -> List[str]:
+    """Spread functions over `files` small .rs files, round robin."""
+    paths = [os.path.join(path, f"handler_{i}.rs") for i in range(files)]
+    for i, file_path in enumerate(paths):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write("\n\n".join(function.content for function in functions[i::files]) + "\n")
+    return paths
+
+
+async def run_analysis(
+    backend: AnalysisBackend,
+    functions: List[RustFunction],
+    concurrency: int,
+    classifier_model: Optional[str] = None,
+    adaptive: bool = True,
+    hedge_ratio: float = 0.0,
+    files: int = 0,
+):
+    """
+    Analyze the functions in one analyze_functions call or, with files set,
+    spread over that many small files and run through process_files like
+    main.py does.
+    """
+    analyzer = SolanaAnalyzer(
+        "bench",
+        static_classifier=False,
+        max_concurrency=concurrency,
+        adaptive_concurrency=adaptive,
+        requests_per_minute=10**9,
+        tokens_per_minute=10**12,
+        backend=backend,
+        classifier_model=classifier_model,
+        hedge_ratio=hedge_ratio,
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_function_files(tmp_dir, functions, files) if files else []
+        start = time.perf_counter()
+        # analyze_with_model prints every analysis, and process_files every file
+        with contextlib.redirect_stdout(io.StringIO()):
+            if files:
+                records = await process_files(analyzer, paths, "bench", "bench", [], analyze=True)
+                # Failed analyses come back empty
+                analyses = [record["analysis"] or {"error": None} for record in records]
+            else:
+                analyses = await analyzer.analyze_functions(functions)
+        elapsed = time.perf_counter() - start
+    errors = sum("error" in analysis for analysis in analyses)
+    print(f"{len(analyses)} functions in {elapsed:.3f}s  {len(analyses) / elapsed:.1f} functions/s  {errors} errors")
+    print_analysis_stats(analyzer)
+
+
+def bench_analyze(args):
+    """
+    Analysis throughput against the local mock server or a recording, without
+    real OpenAI calls.
+
+    With --replay, completions come from a file recorded earlier with
+    --record, so runs are exactly reproducible and measure only the
+    pipeline's own overhead.
+    """
+    functions = synthetic_functions(args.functions)
+    if args.replay:
+        print(f"Replaying {args.functions} analyses from {args.replay} with concurrency {args.concurrency}")
+        asyncio.run(run_analysis(
+            ReplayBackend(args.replay), functions, args.concurrency, args.classifier_model, not args.fixed, args.hedge_ratio, args.files,
+        ))
+        return
+
+    server = mock_openai.start_server(
+        latency=args.latency,
+        jitter=args.jitter,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        requests_per_minute=args.requests_per_minute,
+        seed=args.seed,
+    )
+    try:
+        host, port = server.server_address
+        backend = OpenAIBackend("mock", base_url=f"http://{host}:{port}/v1")
+        if args.record:
+            backend = ReplayBackend(args.record, backend)
+        print(
+            f"Analyzing {args.functions} functions against the mock server "
+            f"(latency {args.latency}s, {args.error_rate:.0%} errors, {args.rate_limit_rate:.0%} 429s) "
+            f"with concurrency {args.concurrency}"
+        )
+        asyncio.run(run_analysis(
+            backend, functions, args.concurrency, args.classifier_model, not args.fixed, args.hedge_ratio, args.files,
+        ))
+    finally:
+        server.shutdown()
+
+
+def write_synthetic_embeddings(embeddings_dir: str, count: int, dimensions: int, per_program: int = 100_000) -> List[str]:
+    """Random vectors saved like save_embeddings does, per_program rows per file."""
+    rng = np.random.default_rng(0)
+    program_ids = []
+    for start in range(0, count, per_program):
+        program_id = f"program_{start // per_program:04d}"
+        rows = min(per_program, count - start)
+        np.save(f"{embeddings_dir}/{program_id}.embeddings.npy", rng.standard_normal((rows, dimensions), dtype=np.float32))
+        program_ids.append(program_id)
+    return program_ids
+
+
+def bench_index(sizes: List[int], dimensions: int, queries: int, k: int):
+    """
+    Top-k query latency of VectorIndex, float32 and int8, at each size.
+
+    Vectors are random, which is the worst case for int8 recall: real
+    embeddings cluster, so the true neighbours stand out further from the
+    rest. Recall is the share of the exact float32 top k that the int8
+    index also returns.
+    """
+    print(f"Benchmarking {dimensions}-dimensional indexes, {queries} queries each, k={k}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            program_ids = write_synthetic_embeddings(tmp_dir, size, dimensions)
+            rng = np.random.default_rng(1)
+            query_vectors = rng.standard_normal((queries, dimensions), dtype=np.float32)
+
+            top = {}
+            for quantize in (False, True):
+                label = "int8" if quantize else "float32"
+                start = time.perf_counter()
+                index = VectorIndex.build(os.path.join(tmp_dir, label), program_ids, quantize, embeddings_dir=tmp_dir)
+                build_time = time.perf_counter() - start
+                size_mb = sum(
+                    os.path.getsize(os.path.join(tmp_dir, label, name)) for name in os.listdir(os.path.join(tmp_dir, label))
+                ) / 1e6
+
+                index.search(query_vectors[0], k)  # page the vectors in
+                latencies = []
+                top[label] = []
+                for query in query_vectors:
+                    start = time.perf_counter()
+                    hits = index.search(query, k)[0]
+                    latencies.append(time.perf_counter() - start)
+                    top[label].append({(program_id, line) for program_id, line, _ in hits})
+                latencies_ms = np.array(latencies) * 1e3
+                print(
+                    f"{size:>9} {label:<8} {size_mb:9.1f}MB  build {build_time:6.1f}s  "
+                    f"query mean {latencies_ms.mean():8.1f}ms  p50 {np.percentile(latencies_ms, 50):8.1f}ms  "
+                    f"p95 {np.percentile(latencies_ms, 95):8.1f}ms"
+                )
+                del index
+
+            recall = np.mean([len(exact & approximate) / k for exact, approximate in zip(top["float32"], top["int8"])])
+            print(f"{size:>9} int8 recall@{k}: {recall:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parse_parser = subparsers.add_parser("parse", help="per-file RustParser overhead")
+    parse_parser.add_argument("--path", help="directory of .rs files (defaults to a fresh Drift clone)")
+    parse_parser.add_argument("--rounds", type=int, default=3)
+
+    lines_parser = subparsers.add_parser("lines", help="line-number resolution on a large synthetic file")
+    lines_parser.add_argument("--lines", type=int, default=50_000)
+    lines_parser.add_argument("--rounds", type=int, default=3)
+
+    analyze_parser = subparsers.add_parser("analyze", help="analysis throughput against a mock OpenAI server")
+    analyze_parser.add_argument("--functions", type=int, default=500)
+    analyze_parser.add_argument("--concurrency", type=int, default=16, help="starting concurrency window")
+    analyze_parser.add_argument("--fixed", action="store_true", help="keep the concurrency window fixed")
+    analyze_parser.add_argument("--latency", type=float, default=0.2, help="seconds each mock completion takes")
+    analyze_parser.add_argument("--jitter", type=float, default=0.05)
+    analyze_parser.add_argument("--slow-rate", type=float, default=0.0, help="share of mock completions that are slow")
+    analyze_parser.add_argument("--slow-latency", type=float, default=2.0, help="seconds the slow completions take")
+    analyze_parser.add_argument("--error-rate", type=float, default=0.0)
+    analyze_parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    analyze_parser.add_argument("--requests-per-minute", type=int, default=0, help="mock server rate limit (0 = unlimited)")
+    analyze_parser.add_argument("--seed", type=int, default=0)
+    analyze_parser.add_argument("--hedge-ratio", type=float, default=0.0, help="share of requests that may be hedged")
+    analyze_parser.add_argument("--classifier-model", help="screen functions with this model before the analysis model")
+    analyze_parser.add_argument(
+        "--files", type=int, default=0,
+        help="spread the functions over this many files and run them through process_files (0 = one analyze_functions call)",
+    )
+    analyze_parser.add_argument("--record", help="also record the completions to this JSONL file")
+    analyze_parser.add_argument("--replay", help="replay completions recorded with --record instead of using the mock")
+
+    index_parser = subparsers.add_parser("index", help="vector index query latency")
+    index_parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000, 5_000_000])
+    index_parser.add_argument("--dimensions", type=int, default=256)
+    index_parser.add_argument("--queries", type=int, default=20)
+    index_parser.add_argument("-k", type=int, default=10)
+
+    args = parser.parse_args()
+
+    if args.benchmark == "index":
+        bench_index(args.sizes, args.dimensions, args.queries, args.k)
+    elif args.benchmark == "analyze":
+        bench_analyze(args)
+    elif args.benchmark == "lines":
+        bench_lines(args.lines, args.rounds)
+    elif args.benchmark == "parse":
+        if args.path:
+            bench_parse(args.path, args.rounds)
+            return
+        tmp_dir = f"/tmp/{uuid.uuid4()}"
+        try:
+            print(f"Cloning {DRIFT_REPO_URL} into {tmp_dir}")
+            repo = git.Repo.clone_from(DRIFT_REPO_URL, tmp_dir)
+            repo.git.checkout(DRIFT_COMMIT)
+            bench_parse(os.path.join(tmp_dir, "programs"), args.rounds)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
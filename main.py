@@ -1,214 +1,2466 @@
+from abc import ABC, abstractmethod
 from pathlib import Path
 import git
 import shutil
 import uuid
 import toml
 import os
-from typing import List, Dict, Optional
-from dataclasses import dataclass
-from tree_sitter import Language, Parser
+from typing import List, Dict, Optional, Tuple, Iterable, Iterator, AsyncIterable, AsyncIterator, Mapping, Callable, Union
+from dataclasses import dataclass, field
+from tree_sitter import Language, Parser, Query, Tree
 from tree_sitter_rust import language as rust_language
+import argparse
+import base64
+import contextlib
+import itertools
 import json
+import random
+import re
+import time
+import hashlib
+import marshal
+import sqlite3
+from importlib.metadata import version as package_version
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError, APIConnectionError, InternalServerError
+from openai.types.chat import ChatCompletion
 import solana.rpc.async_api as solana_rpc
 from solana.rpc.async_api import types
 from solders.pubkey import Pubkey
 import asyncio
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
-@dataclass
+# (start_byte, end_byte) of a node in the source file
+Span = Tuple[int, int]
+
+
+def pack_spans(spans: List[Span]) -> bytes:
+    """Pack spans into one bytes object of uint32 offsets (b"" when empty)."""
+    return array('I', [offset for span in spans for offset in span]).tobytes()
+
+
+def unpack_spans(packed: bytes) -> List[Span]:
+    offsets = memoryview(packed).cast('I')
+    return [(offsets[i], offsets[i + 1]) for i in range(0, len(offsets), 2)]
+
+
+@dataclass(slots=True)
 class RustFunction:
+    """
+    A function parsed out of a Rust file.
+
+    Functions don't copy their text out of the file: they keep byte offsets
+    into the file buffer, which is shared by every function from the same
+    file, and decode content, attributes and docstring on access. Attribute
+    and docstring spans are packed with pack_spans.
+    """
+    source: bytes = field(repr=False)
     name: str
-    content: str
+    start_byte: int
+    end_byte: int
     start_line: int
     end_line: int
-    attributes: List[str]  # For catching things like #[derive(...)] or #[account]
-    docstring: Optional[str]
+    attribute_spans: bytes  # For catching things like #[derive(...)] or #[account]
+    docstring_spans: bytes
+
+    def text(self, span: Span) -> str:
+        return str(memoryview(self.source)[span[0]:span[1]], 'utf-8')
+
+    @property
+    def content(self) -> str:
+        return self.text((self.start_byte, self.end_byte))
+
+    @property
+    def attributes(self) -> List[str]:
+        return [self.text(span) for span in unpack_spans(self.attribute_spans)]
+
+    @property
+    def docstring(self) -> Optional[str]:
+        if not self.docstring_spans:
+            return None
+        return '\n'.join(self.text(span) for span in unpack_spans(self.docstring_spans))
+
+    @classmethod
+    def from_text(cls, name: str, content: str, start_line: int, end_line: int,
+                  attributes: List[str], docstring: Optional[str]) -> "RustFunction":
+        """Rebuild a function from its text, e.g. from a saved result record."""
+        source = bytearray()
+
+        def append(text: str) -> Span:
+            start = len(source)
+            source.extend(text.encode('utf-8'))
+            span = (start, len(source))
+            source.extend(b"\n")
+            return span
+
+        docstring_spans = [append(docstring)] if docstring is not None else []
+        attribute_spans = [append(attribute) for attribute in attributes]
+        start_byte, end_byte = append(content)
+        return cls(bytes(source), name, start_byte, end_byte, start_line, end_line,
+                   pack_spans(attribute_spans), pack_spans(docstring_spans))
+
+    def record(self) -> tuple:
+        """Every field but the source, i.e. RustFunction(source, *record)."""
+        return (self.name, self.start_byte, self.end_byte, self.start_line, self.end_line,
+                self.attribute_spans, self.docstring_spans)
+
+
+class ParseCache:
+    """
+    On-disk cache of RustParser output, keyed by each file's git blob id.
+
+    Entries only hold function records (names, offsets and line numbers) in
+    marshal format; the text comes from the file being parsed, so a hit skips
+    tree-sitter entirely. Entries live under a version key that changes with
+    VERSION or the tree-sitter packages, and stale versions are deleted unless
+    sweep is off (as in parse workers, whose parent process already swept).
+    Once the cache grows past max_bytes, the least recently used entries go
+    first; its size is only scanned once something is added.
+    """
+    # Bump whenever RustParser output changes
+    VERSION = 1
+    # Only directories named like a version key are ever deleted, since
+    # cache_dir may be shared with other state (e.g. .cache/batches)
+    VERSION_KEY_PATTERN = re.compile(r"v\d+-ts.+-rust.+")
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024, sweep: bool = True):
+        version_key = f"v{self.VERSION}-ts{package_version('tree-sitter')}-rust{package_version('tree-sitter-rust')}"
+        self.cache_dir = cache_dir
+        self.root = Path(cache_dir) / version_key
+        self.max_bytes = max_bytes
+
+        if sweep and Path(cache_dir).exists():
+            for stale in Path(cache_dir).iterdir():
+                if stale.name != version_key and stale.is_dir() and self.VERSION_KEY_PATTERN.fullmatch(stale.name):
+                    shutil.rmtree(stale, ignore_errors=True)
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Bytes in the cache, scanned on the first put
+        self.size: Optional[int] = None
+
+    @staticmethod
+    def blob_id(source: bytes) -> str:
+        """The id git gives a blob with these contents."""
+        return hashlib.sha1(b"blob %d\0" % len(source) + source).hexdigest()
+
+    def path(self, blob_id: str) -> Path:
+        return self.root / blob_id[:2] / blob_id
+
+    def get(self, blob_id: str) -> Optional[List[tuple]]:
+        path = self.path(blob_id)
+        try:
+            records = marshal.loads(path.read_bytes())
+            # Mark as recently used for eviction
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return records
+
+    def put(self, blob_id: str, records: List[tuple]):
+        path = self.path(blob_id)
+        data = marshal.dumps(records)
+        path.parent.mkdir(exist_ok=True)
+        # Write then rename, so parse workers sharing the cache never see a partial entry
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        if self.size is None:
+            self.size = sum(entry.stat().st_size for entry in self.root.glob("*/*"))
+        else:
+            self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache is at 80% of max_bytes."""
+        entries = []
+        for entry in self.root.glob("*/*"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if self.size <= self.max_bytes * 0.8:
+                break
+            entry.unlink(missing_ok=True)
+            self.size -= size
+
+
+class RustParser:
+    # Tree-sitter queries used by the extractors, keyed by item kind. They are
+    # compiled on first use and then reused for every file this parser sees.
+    QUERY_SOURCES = {
+        "function": "(function_item) @function",
+        "identifier": "[(identifier) (field_identifier) (type_identifier)] @name",
+        # Anchor account constraints like #[account(seeds = [...], bump)]
+        "seeds_constraint": '(token_tree (identifier) @constraint . "=" (#eq? @constraint "seeds"))',
+        "call": "(call_expression function: (_) @callee)",
+        "path": "[(scoped_identifier path: (_) @path) (scoped_type_identifier path: (_) @path)]",
+        "parameter_type": "(parameter type: (_) @type)",
+    }
+
+    # Identifiers that settle a function's category without asking a model
+    CPI_IDENTIFIERS = {'invoke', 'invoke_signed', 'invoke_unchecked', 'invoke_signed_unchecked', 'CpiContext'}
+    DERIVATION_IDENTIFIERS = {'find_program_address', 'try_find_program_address', 'create_program_address', 'create_with_seed'}
+    # Identifiers that hint at either category, but not reliably enough to decide it
+    HINT_IDENTIFIERS = {
+        'cpi', 'seeds', 'signer_seeds', 'bump', 'with_signer', 'program_id', 'to_account_info',
+        'AccountInfo', 'AccountMeta', 'Instruction', 'Program', 'Pubkey',
+    }
+    # Modules whose functions are CPI wrappers, e.g. token::transfer
+    CPI_MODULES = {
+        'token', 'token_2022', 'token_interface', 'associated_token', 'anchor_spl', 'spl_token',
+        'spl_token_2022', 'spl_associated_token_account', 'system_program', 'system_instruction',
+    }
+    # Callees like Ok, Some or Error::Custom only build a value, so they can't make a CPI
+    CONSTRUCTOR_PATTERN = re.compile(r"(?:\w+::)*[A-Z]\w*")
+
+    def __init__(self, cache: Optional[ParseCache] = None):
+        self.parser = Parser(Language(rust_language()))
+        self.queries: Dict[str, Query] = {}
+        self.cache = cache
+
+    def query(self, kind: str) -> Query:
+        """Return the compiled query for an item kind, compiling it once."""
+        query = self.queries.get(kind)
+        if query is None:
+            query = self.parser.language.query(self.QUERY_SOURCES[kind])
+            self.queries[kind] = query
+        return query
+
+    # Nodes the trivia walk descends into. Items nested inside function bodies
+    # are rare, so rather than walking every statement they fall back to a
+    # sibling scan.
+    ITEM_CONTAINERS = {
+        'source_file', 'declaration_list', 'mod_item', 'impl_item', 'trait_item',
+        'foreign_mod_item',
+    }
+    COMMENT_TYPES = {'line_comment', 'block_comment'}
+    NO_TRIVIA = (b"", b"")
+
+    def collect_trivia(self, tree) -> Dict[int, Tuple[bytes, bytes]]:
+        """
+        Collect the attributes and comments (`///`, `//!`, `//` and `/* */`)
+        leading every item in the file, in one TreeCursor walk.
+
+        Returns packed (attribute spans, docstring spans) keyed by item node id.
+        """
+        trivia = {}
+        attributes, comments = [], []
+        cursor = tree.walk()
+        while True:
+            node = cursor.node
+            node_type = node.type
+            if node_type == 'attribute_item':
+                attributes.append((node.start_byte, node.end_byte))
+            elif node_type in self.COMMENT_TYPES:
+                comments.append((node.start_byte, node.end_byte))
+            else:
+                if node_type.endswith('_item'):
+                    trivia[node.id] = (pack_spans(attributes), pack_spans(comments)) if attributes or comments else self.NO_TRIVIA
+                attributes, comments = [], []
+                if node_type in self.ITEM_CONTAINERS and cursor.goto_first_child():
+                    continue
+
+            while not cursor.goto_next_sibling():
+                if not cursor.goto_parent():
+                    return trivia
+                # Trivia at the end of a block doesn't lead anything
+                attributes, comments = [], []
+
+    def scan_trivia(self, node) -> Tuple[bytes, bytes]:
+        """Collect the trivia leading a single node by scanning its siblings."""
+        attributes, comments = [], []
+        current = node.prev_sibling
+        while current is not None and (current.type == 'attribute_item' or current.type in self.COMMENT_TYPES):
+            spans = attributes if current.type == 'attribute_item' else comments
+            spans.append((current.start_byte, current.end_byte))
+            current = current.prev_sibling
+        attributes.reverse()
+        comments.reverse()
+        return pack_spans(attributes), pack_spans(comments)
+
+    def parse_function(self, function: RustFunction) -> Tuple[bytes, Tree]:
+        """Reparse a function on its own, attributes included."""
+        attribute_spans = unpack_spans(function.attribute_spans)
+        start = attribute_spans[0][0] if attribute_spans else function.start_byte
+        snippet = function.source[start:function.end_byte]
+        return snippet, self.parser.parse(snippet)
+
+    def fingerprint(self, function: RustFunction) -> str:
+        """
+        Hash a function's attributes and body token by token, skipping
+        comments, so copies that only differ in formatting or comments match.
+        """
+        snippet, tree = self.parse_function(function)
+        digest = hashlib.sha256()
+        cursor = tree.walk()
+        while True:
+            node = cursor.node
+            if node.type not in self.COMMENT_TYPES:
+                if node.child_count == 0:
+                    digest.update(snippet[node.start_byte:node.end_byte])
+                    digest.update(b"\0")
+                elif cursor.goto_first_child():
+                    continue
+
+            while not cursor.goto_next_sibling():
+                if not cursor.goto_parent():
+                    return digest.hexdigest()
+
+    def classify(self, function: RustFunction) -> Tuple[str, List[str]]:
+        """
+        Statically classify a function as 'cpi', 'account_derivation',
+        'irrelevant' or 'ambiguous' from the identifiers in its attributes and
+        body, returning the category and the identifiers that decided it.
+
+        Irrelevant is conservative: only functions that call nothing but
+        constructors, use no path into a CPI module and take no Context can
+        be skipped. Anything else the identifiers don't settle is ambiguous.
+        """
+        _, tree = self.parse_function(function)
+        root = tree.root_node
+
+        # The function's own name says nothing about what it calls
+        names = {
+            (child.child_by_field_name("name").start_byte, child.child_by_field_name("name").end_byte)
+            for child in root.children if child.type == "function_item"
+        }
+        identifiers = {
+            node.text.decode('utf8')
+            for node in self.query("identifier").captures(root).get("name", [])
+            if (node.start_byte, node.end_byte) not in names
+        }
+        cpi = sorted(identifiers & self.CPI_IDENTIFIERS)
+        if cpi:
+            return "cpi", cpi
+        derivation = sorted(identifiers & self.DERIVATION_IDENTIFIERS)
+        if self.query("seeds_constraint").captures(tree.root_node):
+            derivation.append("seeds constraint")
+        if derivation:
+            return "account_derivation", derivation
+        hints = sorted(identifiers & self.HINT_IDENTIFIERS)
+        if hints:
+            return "ambiguous", hints
+
+        modules = sorted({
+            segment
+            for node in self.query("path").captures(root).get("path", [])
+            for segment in node.text.decode('utf8').split("::")
+            if segment in self.CPI_MODULES
+        })
+        if modules:
+            return "ambiguous", modules
+        if any(
+            re.search(r"\bContext\b", node.text.decode('utf8'))
+            for node in self.query("parameter_type").captures(root).get("type", [])
+        ):
+            return "ambiguous", ["Context"]
+        calls = sorted({
+            (node.child_by_field_name("field") if node.type == "field_expression" else node).text.decode('utf8')
+            for node in self.query("call").captures(root).get("callee", [])
+            if not self.CONSTRUCTOR_PATTERN.fullmatch(node.text.decode('utf8'))
+        })
+        if calls:
+            return "ambiguous", calls[:5]
+        return "irrelevant", []
+
+    def parse_file(self, file_path: str) -> List[RustFunction]:
+        """Parse a Rust file and extract all functions with their metadata."""
+        return list(self.iter_functions(file_path))
+
+    def iter_functions(self, file_path: str) -> Iterator[RustFunction]:
+        """Parse a Rust file and yield its functions one at a time."""
+        # Tree-sitter offsets are byte offsets, so keep the file as one bytes
+        # buffer that every function from this file points into.
+        with open(file_path, 'rb') as f:
+            source = f.read()
+
+        if self.cache is not None:
+            blob_id = self.cache.blob_id(source)
+            records = self.cache.get(blob_id)
+            if records is not None:
+                for record in records:
+                    yield RustFunction(source, *record)
+                return
+            records = []
+            
+        tree = self.parser.parse(source)
+
+        trivia = self.collect_trivia(tree)
+
+        # Find all function nodes
+        matches = self.query("function").matches(tree.root_node)
+        for match in matches:
+            # Get the function node from the match dictionary
+            func_node = match[1]['function'][0]  # Access the Node from the dictionary
+            name_node = func_node.child_by_field_name('name')
+            
+            if name_node:
+                # Extract line numbers (tree-sitter rows are zero-based)
+                start_line = func_node.start_point[0] + 1
+                end_line = func_node.end_point[0] + 1
+                
+                # Get docstring and attributes
+                attribute_spans, docstring_spans = trivia.get(func_node.id) or self.scan_trivia(func_node)
+                
+                function = RustFunction(
+                    source=source,
+                    name=name_node.text.decode('utf8'),
+                    start_byte=func_node.start_byte,
+                    end_byte=func_node.end_byte,
+                    start_line=start_line,
+                    end_line=end_line,
+                    attribute_spans=attribute_spans,
+                    docstring_spans=docstring_spans
+                )
+                if self.cache is not None:
+                    records.append(function.record())
+                yield function
+
+        if self.cache is not None:
+            self.cache.put(blob_id, records)
+
+ANALYSIS_MODEL = "gpt-4-turbo-preview"
+
+ANALYSIS_SYSTEM_PROMPT = """
+        You are a Solana smart contract analyzer focusing on tool and SDK usage patterns.
+
+        You will be given a Rust function and its attributes, your job is to analyze functions 
+        that have one of the following key categories:
+        - (account_derivation) Account Derivations (Program Derived Address, account address validation, etc)
+        - (cpi) CPIs (invoke, invoke_signed, anchor cpi calls, etc)
+
+        If the function is not one of the above categories, use the skip tool.
+        """
+
+ANALYSIS_TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "analyze_function",
+        "description": "Store useful information about the function for developer searchability",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "category": {
+                    "type": "string",
+                    "description": "One of the following categories: account_derivation, cpi"
+                },
+                "description": {
+                    "type": "string",
+                    "description": "Brief description of the function purpose"
+                }
+            },
+            "required": ["category", "description"],
+        },
+    }
+}, {"type":"function", "function":{"name": "skip", "description": "Skip the function analysis", "parameters": {}}}]
+
+
+PACKED_SYSTEM_PROMPT = """
+        You are a Solana smart contract analyzer focusing on tool and SDK usage patterns.
+
+        You will be given several numbered Rust functions and their attributes, your job is to
+        analyze each function against the following key categories:
+        - (account_derivation) Account Derivations (Program Derived Address, account address validation, etc)
+        - (cpi) CPIs (invoke, invoke_signed, anchor cpi calls, etc)
+
+        Call analyze_functions once, with one result per function, using the function's number as its index.
+        If a function is not one of the above categories, give it the category skip.
+        """
+
+PACKED_TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "analyze_functions",
+        "description": "Store useful information about each function for developer searchability",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "index": {
+                                "type": "integer",
+                                "description": "Number of the function this result is for"
+                            },
+                            "category": {
+                                "type": "string",
+                                "description": "One of the following categories: account_derivation, cpi, skip"
+                            },
+                            "description": {
+                                "type": "string",
+                                "description": "Brief description of the function purpose"
+                            }
+                        },
+                        "required": ["index", "category", "description"],
+                    }
+                }
+            },
+            "required": ["results"],
+        },
+    }
+}]
+
+
+# Pieces a BPE tokenizer like cl100k_base never merges across
+TOKEN_PIECE_PATTERN = re.compile(r"[A-Za-z]+|\d+|\s+|[^\sA-Za-z\d]")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimate how many tokens `text` costs, without a tokenizer and erring high.
+
+    Letter runs cost a token per four letters, digit runs a token per three
+    digits, and punctuation a token per character. Whitespace is free when it
+    is a single space (merged into the next word), and a token per run otherwise.
+    """
+    tokens = 0
+    for piece in TOKEN_PIECE_PATTERN.findall(text):
+        first = piece[0]
+        if first.isalpha():
+            tokens += (len(piece) + 3) // 4
+        elif first.isdigit():
+            tokens += (len(piece) + 2) // 3
+        elif first.isspace():
+            tokens += piece != " "
+        else:
+            tokens += 1
+    return tokens
+
+
+CLASSIFIER_SYSTEM_PROMPT = """
+        You are a Solana smart contract analyzer focusing on tool and SDK usage patterns.
+
+        You will be given a Rust function and its attributes, your job is to classify it with the
+        classify_function tool as one of the following:
+        - (account_derivation) Account Derivations (Program Derived Address, account address validation, etc)
+        - (cpi) CPIs (invoke, invoke_signed, anchor cpi calls, etc)
+        - (skip) Neither of the above
+        - (unsure) Possibly one of the above, but you can't tell from the function alone
+        """
+
+CLASSIFIER_TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "classify_function",
+        "description": "Record the function's category",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "category": {
+                    "type": "string",
+                    "enum": ["cpi", "account_derivation", "skip", "unsure"],
+                }
+            },
+            "required": ["category"],
+        },
+    }
+}]
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff with full jitter: a random delay up to base * 2**attempt, capped."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_reset_duration(value: str) -> float:
+    """Parse an x-ratelimit-reset-* header like "20ms", "1s" or "6m0s" into seconds."""
+    seconds = 0.0
+    for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+class RateLimiter:
+    """
+    Token buckets for requests per minute and tokens per minute.
+
+    The buckets are kept in line with the x-ratelimit-* headers on every
+    response, so the limiter tracks the account's real quota rather than
+    the configured guess, and a 429 blocks every caller until the provider's
+    reset time.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_budget = float(requests_per_minute)
+        self.token_budget = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        # Callers queue on the lock, so they're served in order
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_budget = min(self.requests_per_minute, self.request_budget + elapsed * self.requests_per_minute / 60)
+        self.token_budget = min(self.tokens_per_minute, self.token_budget + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens: int):
+        """Wait until one request of `tokens` tokens fits in the buckets."""
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                self.refill()
+                wait = self.blocked_until - time.monotonic()
+                if wait <= 0:
+                    if self.request_budget >= 1 and self.token_budget >= tokens:
+                        self.request_budget -= 1
+                        self.token_budget -= tokens
+                        return
+                    wait = max(
+                        (1 - self.request_budget) * 60 / self.requests_per_minute,
+                        (tokens - self.token_budget) * 60 / self.tokens_per_minute,
+                    )
+                await asyncio.sleep(wait)
+
+    def update(self, headers):
+        """Sync the buckets with the provider's x-ratelimit-* response headers."""
+        self.refill()
+        for kind in ("requests", "tokens"):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit is not None:
+                setattr(self, f"{kind}_per_minute", int(limit))
+            if remaining is not None:
+                budget = f"{kind[:-1]}_budget"
+                setattr(self, budget, min(getattr(self, budget), float(remaining)))
+                reset = headers.get(f"x-ratelimit-reset-{kind}")
+                if int(remaining) == 0 and reset:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + parse_reset_duration(reset))
+
+    def try_acquire(self, tokens: int) -> bool:
+        """Take one request of `tokens` tokens from the buckets if it fits right now, without waiting."""
+        tokens = min(tokens, self.tokens_per_minute)
+        self.refill()
+        if self.lock.locked() or time.monotonic() < self.blocked_until:
+            return False
+        if self.request_budget < 1 or self.token_budget < tokens:
+            return False
+        self.request_budget -= 1
+        self.token_budget -= tokens
+        return True
+
+    def back_off(self, headers, attempt: int) -> float:
+        """Block all callers after a 429, for as long as the provider asks. Returns the delay."""
+        if headers.get("retry-after-ms"):
+            delay = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"):
+            delay = float(headers["retry-after"])
+        else:
+            resets = [parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}", "")) for kind in ("requests", "tokens")]
+            delay = max(resets) or backoff_delay(attempt)
+        # Spread out the callers that all resume when the block lifts
+        delay += random.uniform(0, delay * 0.1)
+        self.refill()
+        self.request_budget = 0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
+
+
+class AdaptiveConcurrency:
+    """
+    Limit on in-flight requests that adapts with AIMD, like TCP congestion
+    control.
+
+    Each success while the window is full grows it by 1/window, i.e. by one
+    per window's worth of successes. A 429, a server error or rising latency
+    (the recent average passing latency_tolerance times the lowest recent
+    average seen, a baseline that creeps up slowly so it can follow real
+    changes in prompt size) halves it, but only for requests sent after the
+    last decrease, so a burst of failures from the same window only counts
+    once. With min_limit == max_limit it's a plain fixed limit.
+    """
+
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 128, latency_tolerance: float = 2.0):
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.condition = asyncio.Condition()
+        self.latency = 0.0
+        self.baseline_latency = 0.0
+        self.samples = 0
+        self.decreased_at = float("-inf")
+        self.completions = deque()
+        self.started = time.monotonic()
+        self.counts = Counter()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def succeeded(self, seconds: float):
+        """Record a successful request that took `seconds`."""
+        now = time.monotonic()
+        self.completions.append(now)
+        while self.completions[0] < now - 60:
+            self.completions.popleft()
+
+        self.samples += 1
+        if self.samples == 1:
+            self.latency = self.baseline_latency = seconds
+        else:
+            self.latency += 0.2 * (seconds - self.latency)
+            self.baseline_latency = min(self.baseline_latency * 1.002, self.latency)
+        if self.samples >= 20 and self.latency > self.baseline_latency * self.latency_tolerance:
+            self.decrease("latency", now - seconds)
+        elif self.in_flight >= int(self.limit) and self.limit < self.max_limit:
+            # Only grow while the window is actually in use
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self.counts["increases"] += 1
+
+    def overloaded(self, seconds: float):
+        """Record a 429 or server error for a request that took `seconds`."""
+        self.decrease("overload", time.monotonic() - seconds)
+
+    def decrease(self, reason: str, sent_at: float):
+        """Halve the window, unless the request sent at `sent_at` went out before the last decrease."""
+        if sent_at < self.decreased_at:
+            return
+        self.decreased_at = time.monotonic()
+        self.limit = max(self.limit / 2, self.min_limit)
+        self.counts[f"{reason}_decreases"] += 1
+
+    def stats(self) -> Dict:
+        window = min(time.monotonic() - self.started, 60)
+        return {
+            "window": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "throughput_per_second": len(self.completions) / window if window > 0 else 0.0,
+            "latency": self.latency,
+            "baseline_latency": self.baseline_latency,
+            **self.counts,
+        }
+
+
+class HedgeBudget:
+    """
+    When to hedge a request, i.e. send a duplicate if the first hasn't
+    answered by the observed p95 latency.
+
+    Every request earns `ratio` hedges (capped at 1, so hedging can at most
+    double what's sent) and every hedge spends one, so hedges stay within
+    that share of requests across the whole run. The p95 comes from the last
+    `window` successful requests, and nothing is hedged before min_samples.
+    A ratio of 0 disables hedging but still tracks latency.
+    """
+
+    def __init__(self, ratio: float = 0.0, percentile: float = 0.95, window: int = 1000, min_samples: int = 20):
+        self.ratio = min(max(ratio, 0.0), 1.0)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.budget = 0.0
+        self.counts = Counter()
+
+    def record(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(q * (len(latencies) - 1))]
+
+    def delay(self) -> Optional[float]:
+        """Seconds to wait before hedging a request that's being sent now, or None to not hedge it."""
+        self.counts["requests"] += 1
+        self.budget = min(self.budget + self.ratio, 10.0)
+        if self.ratio == 0 or len(self.latencies) < self.min_samples:
+            return None
+        return self.quantile(self.percentile)
+
+    def take(self) -> bool:
+        """Spend a hedge from the budget, if there's one left."""
+        if self.budget < 1:
+            self.counts["over_budget"] += 1
+            return False
+        self.budget -= 1
+        self.counts["hedges"] += 1
+        return True
+
+    def refund(self):
+        """Give back a hedge taken for a request the rate limits then didn't allow."""
+        self.budget += 1
+        self.counts["hedges"] -= 1
+        self.counts["rate_limited"] += 1
+
+    def stats(self) -> Dict:
+        return {
+            **self.counts,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class SqliteCache:
+    """
+    Key/value cache in a local SQLite file, evicting the least recently used
+    entries once the stored values pass max_bytes.
+
+    hits and misses count lookups made through this instance, i.e. one run.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+        self.max_bytes = max_bytes
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self.db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE cache SET used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, value: bytes):
+        old = self.db.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+        self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+        self.size += len(value) - (old[0] if old else 0)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache is at 80% of max_bytes."""
+        to_free = self.size - self.max_bytes * 0.8
+        cutoff = None
+        for size, used in self.db.execute("SELECT size, used FROM cache ORDER BY used"):
+            if to_free <= 0:
+                break
+            to_free -= size
+            cutoff = used
+        if cutoff is not None:
+            self.db.execute("DELETE FROM cache WHERE used <= ?", (cutoff,))
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": self.size,
+        }
+
+
+class AnalysisBackend(ABC):
+    """
+    Where SolanaAnalyzer sends chat completion requests.
+
+    complete returns the completion and the response headers, and raises the
+    openai exceptions (RateLimitError etc.) for failed requests so the
+    analyzer's retries and rate limiting work the same for every backend.
+    """
+
+    @abstractmethod
+    async def complete(self, request: Dict) -> Tuple[ChatCompletion, Mapping[str, str]]:
+        ...
+
+
+class ConnectionStats:
+    """
+    Connection reuse of an httpx client, counted from httpcore's trace
+    extension: requests sent, TCP connections opened, TLS handshakes and the
+    HTTP version each request went out on.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+
+    async def on_request(self, request: httpx.Request):
+        # httpx event hook: trace every request this client sends
+        request.extensions["trace"] = self.trace
+
+    async def trace(self, event: str, info: Dict):
+        if event == "connection.connect_tcp.complete":
+            self.counts["connections"] += 1
+        elif event == "connection.start_tls.complete":
+            self.counts["tls_handshakes"] += 1
+        elif event.endswith(".send_request_headers.started"):
+            # http11.send_request_headers.started or http2.send_request_headers.started
+            self.counts["requests"] += 1
+            self.counts[f"{event.split('.')[0]}_requests"] += 1
+
+    def stats(self) -> Dict:
+        requests = self.counts["requests"]
+        return {
+            **self.counts,
+            "reuse_rate": 1 - self.counts["connections"] / requests if requests else 0.0,
+        }
+
+
+class OpenAIBackend(AnalysisBackend):
+    """
+    The OpenAI API, or any OpenAI-compatible server at base_url (such as
+    mock_openai.py).
+
+    The connection pool is sized for the analyzer's concurrency and keeps
+    idle connections long enough to outlast rate limit pauses, so requests
+    reuse connections instead of paying a TLS handshake each. HTTP/2 is
+    opt-in, since it needs the h2 package (uv add "httpx[http2]").
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: Optional[str] = None,
+        max_connections: int = 64,
+        max_keepalive_connections: int = 64,
+        keepalive_expiry: float = 60.0,
+        http2: bool = False,
+        timeout: httpx.Timeout = httpx.Timeout(180.0, connect=10.0),
+    ):
+        self.connection_stats = ConnectionStats()
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            http2=http2,
+            timeout=timeout,
+            event_hooks={"request": [self.connection_stats.on_request]},
+        )
+        # Retries are handled by SolanaAnalyzer, so its rate limiter sees every 429
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client)
+
+    async def complete(self, request: Dict) -> Tuple[ChatCompletion, Mapping[str, str]]:
+        raw_response = await self.client.chat.completions.with_raw_response.create(**request)
+        return raw_response.parse(), raw_response.headers
+
+
+class ReplayBackend(AnalysisBackend):
+    """
+    Records completions to a JSONL file, or replays them, for reproducible
+    offline runs.
+
+    Given a backend, requests are passed through to it and each completion is
+    appended to path. Without one, completions are served from path by
+    request, and requests that were never recorded raise KeyError.
+    """
+
+    def __init__(self, path: str, backend: Optional[AnalysisBackend] = None):
+        self.path = Path(path)
+        self.backend = backend
+        self.responses: Dict[str, Dict] = {}
+        if backend is None:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        item = json.loads(line)
+                        self.responses[item["key"]] = item["response"]
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def request_key(request: Dict) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    async def complete(self, request: Dict) -> Tuple[ChatCompletion, Mapping[str, str]]:
+        key = self.request_key(request)
+        if self.backend is None:
+            response = self.responses.get(key)
+            if response is None:
+                raise KeyError(f"No recorded completion for request {key[:12]} in {self.path}")
+            return ChatCompletion.model_validate(response), {}
+
+        completion, headers = await self.backend.complete(request)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({"key": key, "response": completion.model_dump(mode="json")}) + '\n')
+        return completion, headers
+
+
+class SolanaAnalyzer:
+    # Retries per function for 429s, 5xx and connection errors
+    MAX_ATTEMPTS = 8
+    # Completion tokens reserved per request in the tokens-per-minute bucket
+    COMPLETION_TOKENS = 200
+    # Per-message framing the API adds on top of the message contents
+    MESSAGE_TOKENS = 4
+    # Lines that must survive trimming: CPI and derivation call sites and seeds
+    KEEP_LINE_PATTERN = re.compile(r"\b(?:%s)\b" % "|".join(sorted(
+        RustParser.CPI_IDENTIFIERS | RustParser.DERIVATION_IDENTIFIERS | {'cpi', 'seeds', 'signer_seeds', 'with_signer'}
+    )))
+    # Lines kept around each call site, so its arguments make it into the prompt
+    KEEP_CONTEXT_LINES = 2
+    # OpenAI only caches prompt prefixes of at least this many tokens
+    PROMPT_CACHE_MIN_TOKENS = 1024
+
+    def __init__(
+        self,
+        openai_api_key: str,
+        parse_cache: Optional[ParseCache] = None,
+        static_classifier: bool = True,
+        max_concurrency: int = 16,
+        adaptive_concurrency: bool = True,
+        max_adaptive_concurrency: int = 128,
+        requests_per_minute: int = 500,
+        tokens_per_minute: int = 30_000,
+        analysis_cache: Optional[SqliteCache] = None,
+        dedupe: bool = True,
+        pack_tokens: int = 0,
+        max_prompt_tokens: int = 16_000,
+        long_context_model: Optional[str] = None,
+        long_context_tokens: int = 128_000,
+        backend: Optional[AnalysisBackend] = None,
+        model: str = ANALYSIS_MODEL,
+        cascade: bool = True,
+        classifier_model: Optional[str] = None,
+        hedge_ratio: float = 0.0,
+        http2: bool = False,
+    ):
+        self.backend = backend or OpenAIBackend(
+            openai_api_key,
+            max_connections=max_adaptive_concurrency,
+            max_keepalive_connections=max_adaptive_concurrency,
+            http2=http2,
+        )
+        self.model = model
+        # With cascade on (the default), functions the static classifier files
+        # as cpi or account_derivation are described by the model instead of
+        # getting a canned "Uses invoke_signed" description. With a classifier_model, functions the static
+        # classifier is unsure of are first classified by that (cheaper) model,
+        # and only go to the analysis model unless it says skip.
+        self.cascade = cascade
+        self.classifier_model = classifier_model
+        self.parser = RustParser(parse_cache)
+        self.static_classifier = static_classifier
+        # Requests in flight start at max_concurrency; adaptive_concurrency lets
+        # the limit move between 1 and max_adaptive_concurrency with the load
+        if adaptive_concurrency:
+            self.concurrency = AdaptiveConcurrency(max_concurrency, max_limit=max_adaptive_concurrency)
+        else:
+            self.concurrency = AdaptiveConcurrency(max_concurrency, max_concurrency, max_concurrency)
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        # Share of requests that may be hedged; 0 disables hedging
+        self.hedging = HedgeBudget(hedge_ratio)
+        self.analysis_cache = analysis_cache
+        self.dedupe = dedupe
+        # Prompt token budget for packing several functions into one request; 0 disables packing
+        self.pack_tokens = pack_tokens
+        # Prompts over max_prompt_tokens go to long_context_model if set and they
+        # fit in long_context_tokens, and are trimmed otherwise
+        self.max_prompt_tokens = max_prompt_tokens
+        self.long_context_model = long_context_model
+        self.long_context_tokens = long_context_tokens
+        # Analysis of each unique function seen so far, keyed by fingerprint
+        self.analyses: Dict[str, asyncio.Future] = {}
+        # Cached analyses are only valid for the model, prompt and tools that
+        # produced them, so packed analyses get a key of their own
+        self.prompt_key, self.packed_prompt_key = (
+            ":".join([
+                model,
+                *([classifier_model] if classifier_model else []),
+                hashlib.sha256(system_prompt.encode()).hexdigest(),
+                hashlib.sha256(json.dumps(tools, sort_keys=True).encode()).hexdigest(),
+            ])
+            for system_prompt, tools in ((ANALYSIS_SYSTEM_PROMPT, ANALYSIS_TOOLS), (PACKED_SYSTEM_PROMPT, PACKED_TOOLS))
+        )
+        # Tokens every single-function request starts with, for judging whether prompt caching can apply
+        self.static_prefix_tokens = self.estimate_prompt_tokens({
+            "messages": [{"role": "system", "content": ANALYSIS_SYSTEM_PROMPT}],
+            "tools": ANALYSIS_TOOLS,
+        })
+        self.stats = Counter()
+
+    def cache_key(self, function: RustFunction, packed: bool = False) -> str:
+        """
+        Key for a function's analysis: prompt key (of the packed prompt if
+        packed) plus a whitespace-normalized hash of the prompt inputs.
+        """
+        parts = [function.name, *function.attributes, function.docstring or "", function.content]
+        normalized = "\0".join(" ".join(part.split()) for part in parts)
+        prompt_key = self.packed_prompt_key if packed else self.prompt_key
+        return f"{prompt_key}:{hashlib.sha256(normalized.encode()).hexdigest()}"
+
+    @staticmethod
+    def describe_function(function: RustFunction) -> str:
+        return f"""
+                    Function name: {function.name}
+                    Attributes: {function.attributes}
+                    Docstring: {function.docstring}
+                    
+                    Code:
+                    {function.content}
+                    """
+
+    def build_request(self, function: RustFunction) -> Dict:
+        """
+        Chat completion arguments for analyzing one function.
+
+        The tools and system prompt are the same bytes in every request and
+        come before the function, so the provider can cache them as a prefix.
+        """
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+                {"role": "user", "content": self.describe_function(function)}
+            ],
+            "tools": ANALYSIS_TOOLS,
+            "tool_choice": "required",
+        }
+
+    def build_packed_request(self, functions: List[RustFunction]) -> Dict:
+        """Chat completion arguments for analyzing several functions in one request."""
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": PACKED_SYSTEM_PROMPT},
+                {"role": "user", "content": "\n".join(
+                    f"Function {index}:{self.describe_function(function)}" for index, function in enumerate(functions)
+                )}
+            ],
+            "tools": PACKED_TOOLS,
+            "tool_choice": "required",
+        }
+
+    @classmethod
+    def estimate_prompt_tokens(cls, request: Dict) -> int:
+        """Estimated prompt tokens of a request: its messages plus its tool definitions."""
+        tokens = sum(count_tokens(message["content"]) + cls.MESSAGE_TOKENS for message in request["messages"])
+        return tokens + count_tokens(json.dumps(request.get("tools", [])))
+
+    @classmethod
+    def estimate_tokens(cls, request: Dict) -> int:
+        """Estimated token count of a request, for the tokens-per-minute bucket."""
+        return cls.estimate_prompt_tokens(request) + cls.COMPLETION_TOKENS
+
+    def fit_request(self, function: RustFunction) -> Dict:
+        """
+        Chat completion arguments for analyzing one function, within the prompt limits.
+
+        Oversized functions go to long_context_model when it's set and they fit
+        there, and are trimmed with trim_function otherwise. Raises ValueError if
+        the function can't be made to fit, so oversize never costs a request.
+        """
+        request = self.build_request(function)
+        tokens = self.estimate_prompt_tokens(request)
+        if tokens <= self.max_prompt_tokens:
+            return request
+
+        self.stats["oversize"] += 1
+        if self.long_context_model and tokens <= self.long_context_tokens:
+            self.stats["long_context"] += 1
+            return {**request, "model": self.long_context_model}
+
+        trimmed = self.trim_function(function, self.max_prompt_tokens)
+        if trimmed is None:
+            self.stats["oversize_rejected"] += 1
+            raise ValueError(f"Prompt of ~{tokens} tokens doesn't fit in {self.max_prompt_tokens} even after trimming")
+        self.stats["trimmed"] += 1
+        return self.build_request(trimmed)
+
+    def trim_function(self, function: RustFunction, max_tokens: int) -> Optional[RustFunction]:
+        """
+        Cut a function's body down until its request fits in max_tokens.
+
+        Keeps the signature, the closing line and the CPI and derivation call
+        sites (with KEEP_CONTEXT_LINES around each), then as much of the rest
+        of the body as still fits, from the top. Cut lines are replaced with
+        elision comments. Returns None if even that doesn't fit.
+        """
+        lines = function.content.split('\n')
+        line_tokens = [count_tokens(line) + 1 for line in lines]
+        signature_end = next((i for i, line in enumerate(lines) if '{' in line), 0)
+
+        priority = list(range(signature_end + 1)) + [len(lines) - 1]
+        for i, line in enumerate(lines):
+            if self.KEEP_LINE_PATTERN.search(line):
+                priority.extend(range(max(i - self.KEEP_CONTEXT_LINES, 0), min(i + self.KEEP_CONTEXT_LINES + 1, len(lines))))
+        priority.extend(range(len(lines)))
+
+        empty = RustFunction.from_text(
+            function.name, "", function.start_line, function.end_line, function.attributes, function.docstring
+        )
+        budget = max_tokens - self.estimate_prompt_tokens(self.build_request(empty))
+        # Elision comments aren't known up front, so shrink the budget by any overshoot and retry
+        for _ in range(3):
+            if budget <= 0:
+                return None
+            kept, used = set(), 0
+            for i in priority:
+                if i not in kept and used + line_tokens[i] <= budget:
+                    kept.add(i)
+                    used += line_tokens[i]
+
+            trimmed_lines, elided = [], 0
+            for i, line in enumerate(lines):
+                if i in kept:
+                    if elided:
+                        trimmed_lines.append(f"    // ... {elided} lines elided ...")
+                        elided = 0
+                    trimmed_lines.append(line)
+                else:
+                    elided += 1
+            trimmed = RustFunction.from_text(
+                function.name, '\n'.join(trimmed_lines), function.start_line, function.end_line,
+                function.attributes, function.docstring,
+            )
+            overshoot = self.estimate_prompt_tokens(self.build_request(trimmed)) - max_tokens
+            if overshoot <= 0:
+                return trimmed
+            budget -= overshoot
+        return None
+
+    async def complete(self, request: Dict):
+        """
+        Run a chat completion within the concurrency and rate limits, retrying
+        429s. Each attempt takes its own concurrency slot, so requests waiting
+        out a backoff don't hold the window.
+        """
+        tokens = self.estimate_tokens(request)
+        for attempt in range(self.MAX_ATTEMPTS):
+            await self.rate_limiter.acquire(tokens)
+            async with self.concurrency:
+                start = time.perf_counter()
+                try:
+                    completion, headers = await self.send(request, tokens)
+                except RateLimitError as e:
+                    self.concurrency.overloaded(time.perf_counter() - start)
+                    delay = self.rate_limiter.back_off(e.response.headers, attempt)
+                    self.stats["rate_limited"] += 1
+                    print(f"Rate limited, backing off {delay:.1f}s")
+                    continue
+                except (APIConnectionError, InternalServerError):
+                    self.concurrency.overloaded(time.perf_counter() - start)
+                    if attempt == self.MAX_ATTEMPTS - 1:
+                        raise
+                    self.stats["retried"] += 1
+                else:
+                    seconds = time.perf_counter() - start
+                    self.hedging.record(seconds)
+                    self.concurrency.succeeded(seconds)
+                    self.rate_limiter.update(headers)
+                    self.record_usage(completion, seconds)
+                    return completion
+            await asyncio.sleep(backoff_delay(attempt))
+        raise RuntimeError(f"Still rate limited after {self.MAX_ATTEMPTS} attempts")
+
+    async def send(self, request: Dict, tokens: int) -> Tuple[ChatCompletion, Mapping[str, str]]:
+        """
+        Send a request to the backend, hedging it if it hasn't answered by the
+        observed p95: a duplicate goes out (within the hedge budget and the
+        rate limits), the first success wins and the other is cancelled.
+        """
+        primary = asyncio.ensure_future(self.backend.complete(request))
+        delay = self.hedging.delay()
+        if delay is None:
+            return await primary
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            # The budget goes first, so hedges it doesn't allow never use up rate limit
+            if done or not self.hedging.take():
+                return await primary
+            if not self.rate_limiter.try_acquire(tokens):
+                self.hedging.refund()
+                return await primary
+            hedge = asyncio.ensure_future(self.backend.complete(request))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedging.counts["hedge_wins"] += 1
+                        return task.result()
+            # Both failed
+            return primary.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def record_usage(self, completion: ChatCompletion, seconds: float):
+        """Count a completion's tokens, and its latency by whether any of its prompt was cached."""
+        usage = completion.usage
+        if usage is None:
+            return
+        details = usage.prompt_tokens_details
+        cached_tokens = (details.cached_tokens or 0) if details is not None else 0
+        self.stats["prompt_tokens"] += usage.prompt_tokens
+        self.stats["cached_tokens"] += cached_tokens
+        self.stats["completion_tokens"] += usage.completion_tokens
+        kind = "cached" if cached_tokens else "uncached"
+        self.stats[f"{kind}_requests"] += 1
+        self.stats[f"{kind}_seconds"] += seconds
+
+    def usage_stats(self) -> Dict:
+        prompt_tokens = self.stats["prompt_tokens"]
+        stats = {
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": self.stats["cached_tokens"],
+            "cached_share": self.stats["cached_tokens"] / prompt_tokens if prompt_tokens else 0.0,
+            "completion_tokens": self.stats["completion_tokens"],
+            "static_prefix_tokens": self.static_prefix_tokens,
+        }
+        for kind in ("cached", "uncached"):
+            requests = self.stats[f"{kind}_requests"]
+            stats[f"{kind}_requests"] = requests
+            stats[f"{kind}_mean_seconds"] = self.stats[f"{kind}_seconds"] / requests if requests else 0.0
+        return stats
+
+    async def analyze_function(self, function: RustFunction, packer: Optional["FunctionPacker"] = None) -> Dict:
+        """
+        Analyze a function.
+
+        With dedupe on, functions are fingerprinted with RustParser.fingerprint
+        and each unique function is analyzed once per analyzer; every copy
+        (in this repo or any other the analyzer sees) gets the same result.
+        Functions that need the model go through `packer` when one is given.
+        """
+        if not self.dedupe:
+            return await self.analyze_unique_function(function, packer)
+
+        fingerprint = self.parser.fingerprint(function)
+        self.stats["dedupe_functions"] += 1
+        analysis = self.analyses.get(fingerprint)
+        if analysis is None:
+            self.stats["dedupe_unique"] += 1
+            analysis = asyncio.ensure_future(self.analyze_unique_function(function, packer))
+            self.analyses[fingerprint] = analysis
+        result = await asyncio.shield(analysis)
+        if "error" in result and self.analyses.get(fingerprint) is analysis:
+            # Let the next copy try again
+            del self.analyses[fingerprint]
+        return dict(result)
+
+    def dedupe_stats(self) -> Dict:
+        functions = self.stats["dedupe_functions"]
+        unique = self.stats["dedupe_unique"]
+        return {
+            "functions": functions,
+            "unique": unique,
+            "dedupe_ratio": functions / unique if unique else 1.0,
+        }
+
+    def static_classify(self, function: RustFunction) -> Tuple[str, List[str]]:
+        """The static classifier's (category, evidence), or ambiguous when it's off."""
+        if not self.static_classifier:
+            return "ambiguous", []
+        start = time.perf_counter()
+        category, evidence = self.parser.classify(function)
+        self.stats[f"static_{category}"] += 1
+        self.record_tier("static", time.perf_counter() - start, decided=category == "irrelevant" or (
+            category != "ambiguous" and not self.cascade
+        ))
+        return category, evidence
+
+    def local_analysis(self, function: RustFunction, classified: Optional[Tuple[str, List[str]]] = None) -> Optional[Dict]:
+        """
+        Analyze a function without the model, if possible.
+
+        Functions the static classifier (see static_classify, or `classified`
+        if already run) finds irrelevant are skipped, and without cascade the
+        ones it files as cpi or account_derivation get a canned description.
+        Otherwise the analysis cache is checked. Returns None when the
+        function needs the model.
+        """
+        category, evidence = classified or self.static_classify(function)
+        if category == "irrelevant":
+            # Same as the model calling the skip tool
+            return {}
+        if category != "ambiguous" and not self.cascade:
+            return {"category": category, "description": f"Uses {', '.join(evidence)}"}
+
+        if self.analysis_cache is not None:
+            # Packed runs fall back to single-function requests, so they can use either
+            for packed in (False, True) if self.pack_tokens > 0 else (False,):
+                cached = self.analysis_cache.get(self.cache_key(function, packed))
+                if cached is not None:
+                    return json.loads(cached)
+        return None
+
+    def store_analysis(self, function: RustFunction, analysis: Dict, packed: bool = False):
+        """Remember a model analysis (from the packed prompt if packed) in the analysis cache, if there is one."""
+        if self.analysis_cache is not None:
+            self.analysis_cache.put(self.cache_key(function, packed), json.dumps(analysis).encode())
+
+    async def analyze_unique_function(self, function: RustFunction, packer: Optional["FunctionPacker"] = None) -> Dict:
+        """
+        Send function to OpenAI for analysis, unless local_analysis has it
+        already or the classifier model (if any) finds it irrelevant.
+        """
+        classified = self.static_classify(function)
+        analysis = self.local_analysis(function, classified)
+        if analysis is not None:
+            return analysis
+        if self.classifier_model and classified[0] == "ambiguous":
+            if await self.classify_with_model(function) == "skip":
+                self.store_analysis(function, {})
+                return {}
+        if packer is not None:
+            return await packer.analyze(function)
+        return await self.analyze_with_model(function)
+
+    def build_classifier_request(self, function: RustFunction) -> Dict:
+        """Chat completion arguments for classifying one function with the classifier model."""
+        return {
+            "model": self.classifier_model,
+            "messages": [
+                {"role": "system", "content": CLASSIFIER_SYSTEM_PROMPT},
+                {"role": "user", "content": self.describe_function(function)}
+            ],
+            "tools": CLASSIFIER_TOOLS,
+            "tool_choice": "required",
+        }
+
+    async def classify_with_model(self, function: RustFunction) -> str:
+        """
+        Classify a function with the classifier model: cpi, account_derivation,
+        skip or unsure. Functions too long for it, and failed requests, are unsure.
+        """
+        request = self.build_classifier_request(function)
+        if self.estimate_prompt_tokens(request) > self.max_prompt_tokens:
+            return "unsure"
+        start = time.perf_counter()
+        try:
+            response = await self.complete(request)
+            category = json.loads(response.choices[0].message.tool_calls[0].function.arguments)["category"]
+        except Exception as e:
+            print(f"Error classifying function {function.name}, escalating: {e}")
+            category = "unsure"
+        if category not in ("cpi", "account_derivation", "skip"):
+            category = "unsure"
+        self.stats[f"classifier_{category}"] += 1
+        self.record_tier("classifier", time.perf_counter() - start, decided=category == "skip")
+        return category
+
+    def record_tier(self, tier: str, seconds: float, functions: int = 1, decided: bool = False):
+        """Count a cascade tier handling `functions` in one go; decided ones go no further."""
+        self.stats[f"tier_{tier}_calls"] += 1
+        self.stats[f"tier_{tier}_functions"] += functions
+        self.stats[f"tier_{tier}_seconds"] += seconds
+        if decided:
+            self.stats[f"tier_{tier}_decided"] += functions
+
+    def tier_stats(self) -> Dict:
+        """Functions handled, functions decided and mean call latency of each cascade tier."""
+        stats = {}
+        for tier in ("static", "classifier", "model"):
+            calls = self.stats[f"tier_{tier}_calls"]
+            if calls:
+                stats[tier] = {
+                    "functions": self.stats[f"tier_{tier}_functions"],
+                    "decided": self.stats[f"tier_{tier}_decided"],
+                    "mean_seconds": self.stats[f"tier_{tier}_seconds"] / calls,
+                }
+        return stats
+
+    async def analyze_with_model(self, function: RustFunction) -> Dict:
+        """Send one function to OpenAI for analysis."""
+        start = time.perf_counter()
+        try:
+            response = await self.complete(self.fit_request(function))
+            
+            # return json.loads(response.choices[0].message.content)
+            functionArgs = json.loads(response.choices[0].message.tool_calls[0].function.arguments)
+            self.stats["model"] += 1
+            self.record_tier("model", time.perf_counter() - start, decided=True)
+            print(functionArgs)
+            self.store_analysis(function, functionArgs)
+            return functionArgs
+        except Exception as e:
+            print(f"Error analyzing function {function.name}: {e}")
+            return {"error": str(e)}
+    
+    async def analyze_packed(self, functions: List[RustFunction]) -> List[Dict]:
+        """
+        Analyze several functions in one request, falling back to one request
+        per function if the model's answer doesn't cover each function once.
+        """
+        request = self.build_packed_request(functions)
+        if self.estimate_prompt_tokens(request) > self.max_prompt_tokens:
+            return await asyncio.gather(*(self.analyze_with_model(function) for function in functions))
+        start = time.perf_counter()
+        try:
+            response = await self.complete(request)
+            arguments = json.loads(response.choices[0].message.tool_calls[0].function.arguments)
+            results = {result["index"]: result for result in arguments["results"]}
+            if sorted(results) != list(range(len(functions))) or len(arguments["results"]) != len(functions):
+                raise ValueError(f"expected indexes 0-{len(functions) - 1}, got {sorted(results)}")
+            analyses = []
+            for index, function in enumerate(functions):
+                result = results[index]
+                if result["category"] == "skip":
+                    analysis = {}
+                else:
+                    analysis = {"category": str(result["category"]), "description": str(result["description"])}
+                self.store_analysis(function, analysis, packed=True)
+                analyses.append(analysis)
+        except Exception as e:
+            print(f"Malformed packed analysis of {len(functions)} functions ({e}), analyzing them one by one")
+            self.stats["pack_fallbacks"] += 1
+            return await asyncio.gather(*(self.analyze_with_model(function) for function in functions))
+
+        self.stats["packed_requests"] += 1
+        self.stats["model"] += len(functions)
+        self.record_tier("model", time.perf_counter() - start, functions=len(functions), decided=True)
+        return analyses
+
+    async def analyze_functions(self, functions: List[RustFunction]) -> List[Dict]:
+        """
+        Analyze multiple functions concurrently, within the analyzer's limits.
+
+        With pack_tokens set, the functions that need the model are packed into
+        as few requests as the token budget allows.
+        """
+        packer = FunctionPacker(self) if self.pack_tokens > 0 else None
+        tasks = [self.analyze_function(func, packer) for func in functions]
+        return await asyncio.gather(*tasks) 
+
+    async def iter_analyses(
+        self,
+        functions: Union[Iterable[RustFunction], AsyncIterable[RustFunction]],
+        max_pending: int = 0,
+    ) -> AsyncIterator[Tuple[RustFunction, Dict]]:
+        """
+        Analyze multiple functions concurrently like analyze_functions, but
+        yield (function, analysis) pairs in the order they finish.
+
+        `functions` may be an async iterable, e.g. functions still being
+        parsed; each is queued as soon as it arrives. With max_pending set, at
+        most that many functions wait on their analysis at once, and the next
+        is only taken from `functions` once one finishes, so a long stream of
+        functions stays bounded in memory while keeping the analyzer busy.
+
+        Analyses still running when the consumer stops iterating are cancelled.
+        """
+        packer = FunctionPacker(self) if self.pack_tokens > 0 else None
+
+        async def analyze(function: RustFunction) -> Tuple[RustFunction, Dict]:
+            return function, await self.analyze_function(function, packer)
+
+        if not isinstance(functions, AsyncIterable):
+            functions = iter_async(functions)
+        pending = set()
+        try:
+            async for function in functions:
+                pending.add(asyncio.ensure_future(analyze(function)))
+                # Hand back whatever has finished, only waiting when the queue is full
+                while pending:
+                    if max_pending and len(pending) >= max_pending:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    else:
+                        done = {task for task in pending if task.done()}
+                        if not done:
+                            break
+                        pending -= done
+                    for task in done:
+                        yield task.result()
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def iter_async(items: Iterable) -> AsyncIterator:
+    for item in items:
+        yield item
+
+
+class FunctionPacker:
+    """
+    Collects the functions of one analyze_functions call that need the model
+    and sends them in packs of up to analyzer.pack_tokens prompt tokens.
+
+    The pack is sent once every function in the call has had the chance to
+    join it, i.e. on the event loop iteration after the first one arrives.
+    """
+
+    def __init__(self, analyzer: SolanaAnalyzer):
+        self.analyzer = analyzer
+        self.queue: List[Tuple[RustFunction, asyncio.Future]] = []
+
+    async def analyze(self, function: RustFunction) -> Dict:
+        future = asyncio.get_running_loop().create_future()
+        if not self.queue:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.queue.append((function, future))
+        return await future
+
+    def flush(self):
+        packs = []
+        pack, pack_tokens = [], 0
+        for function, future in self.queue:
+            tokens = count_tokens(self.analyzer.describe_function(function))
+            if pack and pack_tokens + tokens > self.analyzer.pack_tokens:
+                packs.append(pack)
+                pack, pack_tokens = [], 0
+            pack.append((function, future))
+            pack_tokens += tokens
+        if pack:
+            packs.append(pack)
+        self.queue = []
+        for pack in packs:
+            asyncio.ensure_future(self.send(pack))
+
+    async def send(self, pack: List[Tuple[RustFunction, asyncio.Future]]):
+        functions = [function for function, _ in pack]
+        try:
+            if len(functions) == 1:
+                analyses = [await self.analyzer.analyze_with_model(functions[0])]
+            else:
+                analyses = await self.analyzer.analyze_packed(functions)
+        except Exception as e:
+            analyses = [{"error": str(e)} for _ in functions]
+        for (_, future), analysis in zip(pack, analyses):
+            if not future.done():
+                future.set_result(analysis)
+
+
+def function_from_record(record: Dict) -> RustFunction:
+    """Rebuild the RustFunction behind a result record."""
+    function = record["function"]
+    return RustFunction.from_text(
+        function["name"], function["content"], function["start_line"], function["end_line"],
+        function["attributes"], function["docstring"],
+    )
+
+
+class DeadLetters:
+    """
+    JSONL file of functions whose analysis failed for good (after complete's
+    retries), so replay_dead_letters can redo just those functions instead of
+    their whole repos. Each line holds the program id, the result record's
+    file and function, and the error.
+    """
+
+    def __init__(self, path: str = ".cache/dead_letters.jsonl"):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.added = 0
+
+    def add(self, program_id: str, record: Dict, error: str):
+        with open(self.path, 'a') as f:
+            json.dump({
+                "program_id": program_id,
+                "file": record["file"],
+                "function": record["function"],
+                "error": error,
+                "failed_at": time.time(),
+            }, f)
+            f.write('\n')
+        self.added += 1
+
+    def load(self) -> List[Dict]:
+        if not self.path.exists():
+            return []
+        with open(self.path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def rewrite(self, entries: List[Dict]):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            for entry in entries:
+                json.dump(entry, f)
+                f.write('\n')
+        os.replace(tmp_path, self.path)
+
+
+def merge_analyses(
+    analyzer: SolanaAnalyzer,
+    records: List[Dict],
+    results: Dict[str, Dict],
+    program_id: str,
+    dead_letters: Optional[DeadLetters] = None,
+) -> int:
+    """
+    Fill analyses, keyed by function fingerprint, into the records that
+    don't have one yet. Failed analyses are never filled in; they go to
+    dead_letters if given. Returns how many records were filled.
+    """
+    merged = 0
+    for record in records:
+        if record["analysis"]:
+            continue
+        function = function_from_record(record)
+        analysis = results.get(analyzer.parser.fingerprint(function))
+        if analysis is None:
+            continue
+        if "error" in analysis:
+            if dead_letters is not None:
+                dead_letters.add(program_id, record, analysis["error"])
+            continue
+        record["analysis"] = dict(analysis)
+        analyzer.store_analysis(function, analysis)
+        merged += 1
+    return merged
+
+
+class BatchRunner:
+    """
+    Runs analyses through the OpenAI Batch API, for runs where cost and
+    throughput matter more than latency.
+
+    Requests are keyed (custom_id) by function fingerprint, so each unique
+    function is sent once per batch. Every program gets a state file in
+    state_dir from begin() until its results are merged, recording each step
+    (custom_ids and input_file_id, then batch_id) before the next. A run that
+    dies at any point resumes where it stopped: it rebuilds the requests from
+    the saved results, re-uploads them, adopts a batch created from the
+    uploaded file instead of paying for it twice, or goes back to polling.
+    """
+    FINISHED = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(
+        self,
+        analyzer: SolanaAnalyzer,
+        state_dir: str = ".cache/batches",
+        poll_interval: float = 60.0,
+        dead_letters: Optional[DeadLetters] = None,
+    ):
+        if not isinstance(analyzer.backend, OpenAIBackend):
+            raise ValueError("The Batch API needs an analyzer with an OpenAIBackend")
+        self.analyzer = analyzer
+        self.client = analyzer.backend.client
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.poll_interval = poll_interval
+        self.dead_letters = dead_letters
+
+    def state_path(self, name: str) -> Path:
+        return self.state_dir / f"{name}.json"
+
+    def pending(self) -> List[str]:
+        """Names of batches begun whose results haven't been merged yet."""
+        return sorted(path.stem for path in self.state_dir.glob("*.json"))
 
+    def write_state(self, name: str, state: Dict):
+        tmp_path = self.state_path(name).with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self.state_path(name))
 
-class RustParser:
-    def __init__(self):
-        self.parser = Parser(Language(rust_language()))
+    def begin(self, name: str):
+        """
+        Record that results for `name` are about to be saved for a batch, so
+        a run that dies before the batch is created submits it on resume.
+        """
+        self.write_state(name, {})
 
-    def extract_docstring(self, node, source_code: str) -> Optional[str]:
-        """Extract docstring comments preceding a function."""
-        current = node
-        comments = []
-        
-        while current.prev_sibling and current.prev_sibling.type == 'line_comment':
-            comments.insert(0, source_code[current.prev_sibling.start_byte:current.prev_sibling.end_byte])
-            current = current.prev_sibling
-            
-        return '\n'.join(comments) if comments else None
+    async def submit(self, name: str, records: List[Dict]) -> Optional[str]:
+        """
+        Fill in the records that can be analyzed locally, and submit the rest
+        as a batch. Returns the batch id, or None if nothing needs the model.
+        """
+        requests = {}
+        for record in records:
+            function = function_from_record(record)
+            analysis = self.analyzer.local_analysis(function)
+            if analysis is not None:
+                record["analysis"] = analysis
+                continue
+            custom_id = self.analyzer.parser.fingerprint(function)
+            if custom_id not in requests:
+                try:
+                    body = self.analyzer.fit_request(function)
+                except ValueError as e:
+                    if self.dead_letters is not None:
+                        self.dead_letters.add(name, record, str(e))
+                    continue
+                requests[custom_id] = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                }
+        if not requests:
+            self.state_path(name).unlink(missing_ok=True)
+            return None
 
-    def extract_attributes(self, node, source_code: str) -> List[str]:
-        """Extract Rust attributes like #[derive(...)] or #[account]."""
-        current = node
-        attributes = []
-        
-        while current.prev_sibling and current.prev_sibling.type == 'attribute_item':
-            attr_text = source_code[current.prev_sibling.start_byte:current.prev_sibling.end_byte]
-            attributes.insert(0, attr_text)
-            current = current.prev_sibling
-            
-        return attributes
+        input_path = self.state_dir / f"{name}.input.jsonl"
+        with open(input_path, 'w') as f:
+            for request in requests.values():
+                json.dump(request, f)
+                f.write('\n')
+        with open(input_path, 'rb') as f:
+            input_file = await self.client.files.create(file=f, purpose="batch")
+        state = {"custom_ids": list(requests), "input_file_id": input_file.id, "uploaded_at": time.time()}
+        self.write_state(name, state)
+        input_path.unlink()
+        return await self.create_batch(name, state)
 
-    def parse_file(self, file_path: str) -> List[RustFunction]:
-        """Parse a Rust file and extract all functions with their metadata."""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            
-        tree = self.parser.parse(bytes(content, 'utf8'))
-        functions = []
+    async def create_batch(self, name: str, state: Dict) -> str:
+        """Create the batch for an uploaded input file and record its id."""
+        batch = await self.client.batches.create(
+            input_file_id=state["input_file_id"],
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        self.write_state(name, {**state, "batch_id": batch.id})
+        print(f"Submitted batch {batch.id} with {len(state['custom_ids'])} requests for {name}")
+        return batch.id
 
-        # Query to find all function definitions
-        query = self.parser.language.query("""
-            (function_item) @function
-        """)
+    async def find_batch(self, input_file_id: str, since: float) -> Optional[str]:
+        """The id of a batch already created from input_file_id, e.g. by a run that died before recording it."""
+        async for batch in self.client.batches.list(limit=100):
+            if batch.input_file_id == input_file_id:
+                return batch.id
+            # Listed newest first, so older batches can't be from this upload
+            if batch.created_at < since - 60:
+                break
+        return None
 
-        # Find all function nodes
-        matches = query.matches(tree.root_node)
-        for match in matches:
-            # Get the function node from the match dictionary
-            func_node = match[1]['function'][0]  # Access the Node from the dictionary
-            name_node = func_node.child_by_field_name('name')
-            
-            if name_node:
-                # Get the full function text
-                func_text = content[func_node.start_byte:func_node.end_byte]
-                
-                # Extract line numbers
-                start_line = content[:func_node.start_byte].count('\n') + 1
-                end_line = content[:func_node.end_byte].count('\n') + 1
-                
-                # Get docstring and attributes
-                docstring = self.extract_docstring(func_node, content)
-                attributes = self.extract_attributes(func_node, content)
-                
-                function = RustFunction(
-                    name=name_node.text.decode('utf8'),
-                    content=func_text,
-                    start_line=start_line,
-                    end_line=end_line,
-                    attributes=attributes,
-                    docstring=docstring
+    async def resume(self, name: str) -> bool:
+        """
+        Finish submitting a batch a previous run began, from its state file.
+        Returns whether there is a batch to wait for.
+        """
+        state = json.loads(self.state_path(name).read_text())
+        if "batch_id" in state:
+            return True
+        if "input_file_id" in state:
+            batch_id = await self.find_batch(state["input_file_id"], state.get("uploaded_at", 0))
+            if batch_id is not None:
+                print(f"Found batch {batch_id} for {name}, created before the last run stopped")
+                self.write_state(name, {**state, "batch_id": batch_id})
+            else:
+                await self.create_batch(name, state)
+            return True
+        if not os.path.exists(f"jsonl/{name}.jsonl"):
+            # Results were never saved, so the next run processes the program again
+            self.state_path(name).unlink()
+            return False
+        records = load_results_jsonl(name)
+        batch_id = await self.submit(name, records)
+        save_results_as_jsonl(records, name)
+        return batch_id is not None
+
+    async def wait(self, name: str) -> Dict[str, Dict]:
+        """
+        Poll a submitted batch until it finishes, returning analyses by
+        custom_id. Every submitted request gets one; those the batch has no
+        output for (e.g. it expired) get an error, so they're dead-lettered.
+        """
+        state = json.loads(self.state_path(name).read_text())
+        batch_id = state["batch_id"]
+        while True:
+            batch = await self.client.batches.retrieve(batch_id)
+            if batch.status in self.FINISHED:
+                break
+            print(f"Batch {batch_id} for {name} is {batch.status}, polling again in {self.poll_interval:.0f}s")
+            await asyncio.sleep(self.poll_interval)
+
+        if batch.status != "completed":
+            print(f"Batch {batch_id} for {name} {batch.status}; requests without output are dead-lettered")
+
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            content = await self.client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                try:
+                    if response.get("status_code") != 200:
+                        raise ValueError(json.dumps(item.get("error") or response.get("body")))
+                    message = response["body"]["choices"][0]["message"]
+                    results[item["custom_id"]] = json.loads(message["tool_calls"][0]["function"]["arguments"])
+                except Exception as e:
+                    results[item["custom_id"]] = {"error": str(e)}
+        for custom_id in state.get("custom_ids", []):
+            results.setdefault(custom_id, {"error": f"Batch {batch_id} {batch.status} without a result for this request"})
+        return results
+
+    async def complete(self, name: str):
+        """Wait for a batch and merge its results into the saved results for `name`."""
+        if not await self.resume(name):
+            return
+        results = await self.wait(name)
+        records = load_results_jsonl(name)
+        merged = merge_analyses(self.analyzer, records, results, name, self.dead_letters)
+        save_results_as_jsonl(records, name)
+        self.state_path(name).unlink()
+        print(f"Merged {merged} batch analyses into {name}")
+
+    async def complete_all(self):
+        """Finish every pending batch, including ones left by earlier runs."""
+        await asyncio.gather(*(self.complete(name) for name in self.pending()))
+
+
+class EmbeddingBackend(ABC):
+    """
+    Turns texts into vectors. `name` identifies the model (and its settings)
+    in the embedding cache, so vectors from different models never mix.
+    """
+    name = "embeddings"
+    # Most tokens one input may have
+    max_input_tokens = 8191
+
+    @abstractmethod
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        """One float32 row per text."""
+
+
+class OpenAIEmbeddings(EmbeddingBackend):
+    """The embeddings endpoint of the OpenAI API (or a compatible server), through an existing client."""
+    MAX_ATTEMPTS = 6
+
+    def __init__(self, client: AsyncOpenAI, model: str = "text-embedding-3-small", dimensions: Optional[int] = None):
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+        self.name = self.backend_name(model, dimensions)
+
+    @staticmethod
+    def backend_name(model: str, dimensions: Optional[int] = None) -> str:
+        """The name an instance with these settings has, without needing a client."""
+        return f"openai:{model}:{dimensions or 'default'}"
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        options = {"dimensions": self.dimensions} if self.dimensions else {}
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                # base64 comes back as raw float32 bytes, skipping a list of Python floats per vector
+                response = await self.client.embeddings.create(
+                    input=texts, model=self.model, encoding_format="base64", **options
                 )
-                functions.append(function)
+                break
+            except (RateLimitError, APIConnectionError, InternalServerError):
+                if attempt == self.MAX_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
+        rows = sorted(response.data, key=lambda item: item.index)
+        return np.stack([np.frombuffer(base64.b64decode(item.embedding), dtype=np.float32) for item in rows])
 
-        return functions
 
-class SolanaAnalyzer:
-    def __init__(self, openai_api_key: str):
-        self.client = AsyncOpenAI(api_key=openai_api_key)
-        self.parser = RustParser()
+class LocalEmbeddings(EmbeddingBackend):
+    """
+    A local model: any function from a list of texts to an array of vectors,
+    run in a thread so it doesn't block the event loop. sentence_transformer
+    builds one from a sentence-transformers model, if that's installed.
+    """
 
-    async def analyze_function(self, function: RustFunction) -> Dict:
-        """Send function to OpenAI for analysis."""
-        system_prompt = """
-        You are a Solana smart contract analyzer focusing on tool and SDK usage patterns.
+    def __init__(self, encode: Callable[[List[str]], np.ndarray], name: str, max_input_tokens: int = 512):
+        self.encode = encode
+        self.name = f"local:{name}"
+        self.max_input_tokens = max_input_tokens
 
-        You will be given a Rust function and its attributes, your job is to analyze functions 
-        that have one of the following key categories:
-        - (account_derivation) Account Derivations (Program Derived Address, account address validation, etc)
-        - (cpi) CPIs (invoke, invoke_signed, anchor cpi calls, etc)
+    @classmethod
+    def sentence_transformer(cls, model_name: str = "all-MiniLM-L6-v2") -> "LocalEmbeddings":
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name)
+        return cls(model.encode, model_name, model.max_seq_length)
 
-        If the function is not one of the above categories, use the skip tool.
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(await asyncio.to_thread(self.encode, texts), dtype=np.float32)
+
+
+def embedding_text(function: Dict) -> str:
+    """The text embedded for a result record's function: its name, docstring and code."""
+    return "\n".join([function["name"], function.get("docstring") or "", function["content"]])
+
+
+class FunctionEmbedder:
+    """
+    Embeds result records in large batches, reusing cached vectors.
+
+    Vectors are cached by the backend name plus the hash of the embedded
+    text, so re-indexing only pays for functions that changed, and copies of
+    a function are embedded once. Batches hold up to batch_size texts and
+    batch_tokens estimated tokens (the endpoint's per-request limit), and up
+    to max_concurrency of them are in flight.
+    """
+
+    def __init__(
+        self,
+        backend: EmbeddingBackend,
+        cache: Optional[SqliteCache] = None,
+        batch_size: int = 512,
+        batch_tokens: int = 250_000,
+        max_concurrency: int = 4,
+    ):
+        self.backend = backend
+        self.cache = cache
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.stats = Counter()
+
+    def fit_text(self, text: str) -> str:
+        """Cut a text down to the backend's input limit."""
+        tokens = count_tokens(text)
+        if tokens <= self.backend.max_input_tokens:
+            return text
+        self.stats["truncated"] += 1
+        return text[:len(text) * self.backend.max_input_tokens // tokens]
+
+    def cache_key(self, text: str) -> str:
+        return f"{self.backend.name}:{hashlib.sha256(text.encode()).hexdigest()}"
+
+    async def embed_batch(self, texts: List[str]) -> np.ndarray:
+        async with self.semaphore:
+            vectors = await self.backend.embed(texts)
+        self.stats["requests"] += 1
+        self.stats["embedded"] += len(texts)
+        return vectors
+
+    async def embed_records(self, records: List[Dict]) -> np.ndarray:
+        """Vectors for a list of result records, one float32 row per record, in order."""
+        texts = [self.fit_text(embedding_text(record["function"])) for record in records]
+        keys = [self.cache_key(text) for text in texts]
+        vectors: Dict[str, np.ndarray] = {}
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key in vectors or key in missing:
+                continue
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                vectors[key] = np.frombuffer(cached, dtype=np.float32)
+                self.stats["cached"] += 1
+            else:
+                missing[key] = text
+
+        batches, batch, batch_tokens = [], [], 0
+        for key, text in missing.items():
+            tokens = count_tokens(text)
+            if batch and (len(batch) == self.batch_size or batch_tokens + tokens > self.batch_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(key)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+
+        results = await asyncio.gather(*(self.embed_batch([missing[key] for key in batch]) for batch in batches))
+        for batch, batch_vectors in zip(batches, results):
+            for key, vector in zip(batch, batch_vectors):
+                vectors[key] = vector
+                if self.cache is not None:
+                    self.cache.put(key, vector.tobytes())
+
+        if not keys:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([vectors[key] for key in keys]).astype(np.float32, copy=False)
+
+
+class VectorIndex:
+    """
+    Top-k cosine search over the saved function embeddings.
+
+    An index directory holds every program's vectors as one unit-length
+    matrix (vectors.npy), memory-mapped on load, plus meta.json listing the
+    programs in row order and the embedding backend that produced them. A query is one matrix product against the whole
+    matrix. With quantize, vectors are stored as int8 with a float32 scale per
+    row (scales.npy), a quarter of the memory for slightly approximate
+    scores; those are scored in blocks of BLOCK_ROWS so the int8 rows are
+    only ever widened to float32 a block at a time.
+    """
+    BLOCK_ROWS = 1 << 14
+
+    def __init__(self, index_dir: str):
+        self.index_dir = Path(index_dir)
+        meta = json.loads((self.index_dir / "meta.json").read_text())
+        self.quantized = meta["quantized"]
+        # EmbeddingBackend.name of the model the vectors came from; None for older indexes
+        self.embedding_backend: Optional[str] = meta.get("embedding_backend")
+        self.program_ids = [program_id for program_id, _ in meta["programs"]]
+        # Row where each program's vectors start
+        self.offsets = np.cumsum([0] + [count for _, count in meta["programs"]])
+        self.vectors = np.load(self.index_dir / "vectors.npy", mmap_mode='r')
+        self.scales = np.load(self.index_dir / "scales.npy", mmap_mode='r') if self.quantized else None
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @classmethod
+    def build(
+        cls,
+        index_dir: str,
+        program_ids: List[str],
+        quantize: bool = False,
+        embeddings_dir: str = "jsonl",
+        embedding_backend: Optional[str] = None,
+    ) -> "VectorIndex":
+        """
+        Build an index from the programs' <embeddings_dir>/<program_id>.embeddings.npy
+        files. embedding_backend is the EmbeddingBackend.name that produced them.
+        """
+        sources = [np.load(f"{embeddings_dir}/{program_id}.embeddings.npy", mmap_mode='r') for program_id in program_ids]
+        sources = [(program_id, vectors) for program_id, vectors in zip(program_ids, sources) if len(vectors)]
+        if not sources:
+            raise ValueError("No embeddings to index")
+        dimensions = sources[0][1].shape[1]
+        count = sum(len(vectors) for _, vectors in sources)
+
+        index_path = Path(index_dir)
+        index_path.mkdir(parents=True, exist_ok=True)
+        output = np.lib.format.open_memmap(
+            index_path / "vectors.npy", mode='w+', dtype=np.int8 if quantize else np.float32, shape=(count, dimensions)
+        )
+        scales = np.lib.format.open_memmap(
+            index_path / "scales.npy", mode='w+', dtype=np.float32, shape=(count,)
+        ) if quantize else None
+
+        row = 0
+        for program_id, vectors in sources:
+            if vectors.shape[1] != dimensions:
+                raise ValueError(f"{program_id} has {vectors.shape[1]}-dimensional embeddings, expected {dimensions}")
+            for start in range(0, len(vectors), cls.BLOCK_ROWS):
+                block = np.asarray(vectors[start:start + cls.BLOCK_ROWS], dtype=np.float32)
+                block = block / np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+                end = row + len(block)
+                if quantize:
+                    block_scales = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127
+                    output[row:end] = np.round(block / block_scales[:, None]).astype(np.int8)
+                    scales[row:end] = block_scales
+                else:
+                    output[row:end] = block
+                row = end
+        output.flush()
+        if scales is not None:
+            scales.flush()
+        del output, scales
+
+        (index_path / "meta.json").write_text(json.dumps({
+            "quantized": quantize,
+            "dimensions": dimensions,
+            "embedding_backend": embedding_backend,
+            "programs": [[program_id, len(vectors)] for program_id, vectors in sources],
+        }))
+        return cls(index_dir)
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """Cosine similarity of each query (one per row) with every indexed vector."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        if not self.quantized:
+            return queries @ self.vectors.T
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        block = np.empty((min(self.BLOCK_ROWS, len(self)), self.vectors.shape[1]), dtype=np.float32)
+        for start in range(0, len(self), self.BLOCK_ROWS):
+            rows = self.vectors[start:start + self.BLOCK_ROWS]
+            np.copyto(block[:len(rows)], rows)
+            np.matmul(queries, block[:len(rows)].T, out=scores[:, start:start + len(rows)])
+            scores[:, start:start + len(rows)] *= self.scales[start:start + len(rows)]
+        return scores
+
+    def search(self, queries: np.ndarray, k: int = 10) -> List[List[Tuple[str, int, float]]]:
+        """
+        The k nearest vectors to each query, best first, as (program_id, line
+        in the program's JSONL, cosine similarity).
         """
+        results = []
+        for query_scores in self.scores(queries):
+            if k < len(query_scores):
+                top = np.argpartition(-query_scores, k)[:k]
+            else:
+                top = np.arange(len(query_scores))
+            top = top[np.argsort(-query_scores[top])]
+            programs = np.searchsorted(self.offsets, top, side='right') - 1
+            results.append([
+                (self.program_ids[program], int(row - self.offsets[program]), float(query_scores[row]))
+                for row, program in zip(top, programs)
+            ])
+        return results
+
+
+# Each parse worker process owns its own RustParser: tree-sitter parsers can't
+# be pickled or shared across processes.
+_worker_parser: Optional[RustParser] = None
+
+
+def _init_parse_worker(cache_dir: Optional[str]):
+    global _worker_parser
+    # The parent's ParseCache already swept stale versions
+    _worker_parser = RustParser(ParseCache(cache_dir, sweep=False) if cache_dir else None)
+
+
+# (file_path, source, function records, error) for one parsed file
+FileRecords = Tuple[str, Optional[bytes], Optional[List[tuple]], Optional[str]]
+
+
+def parse_file_records(parser: RustParser, file_path: str) -> FileRecords:
+    """
+    Parse one file into its source buffer and compact RustFunction field tuples.
+
+    The records leave out the source, so it's sent back from a worker once per
+    file rather than once per function. Failures are returned rather than
+    raised so one bad file can't take down the rest of the repo.
+    """
+    try:
+        functions = parser.parse_file(file_path)
+    except Exception as e:
+        return file_path, None, None, f"{type(e).__name__}: {e}"
+    source = functions[0].source if functions else b""
+    return file_path, source, [func.record() for func in functions], None
+
+
+def _parse_batch(file_paths: List[str]) -> List[FileRecords]:
+    return [parse_file_records(_worker_parser, file_path) for file_path in file_paths]
 
+
+def create_parse_pool(workers: int, cache_dir: Optional[str] = None) -> ProcessPoolExecutor:
+    """
+    Create a process pool for parsing files in parallel with process_files.
+    Workers start up once per pool, so share one pool across repos.
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_parse_worker, initargs=(cache_dir,))
+
+
+def _batch_functions(batch: List[FileRecords]) -> Iterator[Tuple[str, List[RustFunction]]]:
+    for file_path, source, records, error in batch:
+        if error is not None:
+            print(f"Error parsing {file_path}, skipping: {error}")
+            continue
+        yield file_path, [RustFunction(source, *record) for record in records]
+
+
+async def iter_parsed_files(
+    parser: RustParser,
+    files: List[str],
+    executor: Optional[ProcessPoolExecutor] = None,
+    batch_size: int = 16,
+    prefetch: int = 8,
+) -> AsyncIterator[Tuple[str, List[RustFunction]]]:
+    """
+    Parse files and yield (file_path, functions) pairs in input order.
+
+    With an executor, files are sent to worker processes in batches so parsing
+    uses every core and doesn't block the event loop. At most `prefetch`
+    batches are in flight, so a slow consumer doesn't pile up parsed files.
+    Files that fail to parse are reported and skipped.
+    """
+    if executor is None:
+        for file_path in files:
+            try:
+                functions = parser.parse_file(file_path)
+            except Exception as e:
+                print(f"Error parsing {file_path}, skipping: {type(e).__name__}: {e}")
+                continue
+            yield file_path, functions
+            # Parsing doesn't wait on anything, so let queued analyses start between files
+            await asyncio.sleep(0)
+        return
+
+    loop = asyncio.get_running_loop()
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    pending = deque()
+    next_batch = 0
+    while pending or next_batch < len(batches):
+        while next_batch < len(batches) and len(pending) < prefetch:
+            batch_files = batches[next_batch]
+            pending.append((batch_files, loop.run_in_executor(executor, _parse_batch, batch_files)))
+            next_batch += 1
+
+        batch_files, future = pending.popleft()
         try:
-            response = await self.client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"""
-                    Function name: {function.name}
-                    Attributes: {function.attributes}
-                    Docstring: {function.docstring}
-                    
-                    Code:
-                    {function.content}
-                    """}
-                ],
-                tools=[{
-                    "type": "function",
-                    "function": {
-                        "name": "analyze_function",
-                        "description": "Store useful information about the function for developer searchability",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "category": {
-                                    "type": "string",
-                                    "description": "One of the following categories: account_derivation, cpi"
-                                },
-                                "description": {
-                                    "type": "string",
-                                    "description": "Brief description of the function purpose"
-                                }
-                            },
-                            "required": ["category", "description"],
-                        },
-                    }
-                }, {"type":"function", "function":{"name": "skip", "description": "Skip the function analysis", "parameters": {}}}],
-                tool_choice="required"
-            )
-            
-            # return json.loads(response.choices[0].message.content)
-            functionArgs = json.loads(response.choices[0].message.tool_calls[0].function.arguments)
-            print(functionArgs)
-            return functionArgs
+            batch = await future
         except Exception as e:
-            print(f"Error analyzing function {function.name}: {e}")
-            return {"error": str(e)}
-    
-    async def analyze_functions(self, functions: List[RustFunction]) -> List[Dict]:
-        """Analyze multiple functions concurrently."""
-        tasks = [self.analyze_function(func) for func in functions]
-        return await asyncio.gather(*tasks) 
+            # The worker died (e.g. BrokenProcessPool); redo its batch here
+            print(f"Parse worker failed ({e}), parsing {len(batch_files)} files in-process")
+            batch = [parse_file_records(parser, file_path) for file_path in batch_files]
+        for parsed in _batch_functions(batch):
+            yield parsed
 
 
-async def process_files(analyzer: SolanaAnalyzer, files: List[str], program_id: str, repo_url: str, dependencies: List[Dict]) -> List[Dict]:
-    results = []
-    
-    for file_path in files:
-        print(f"Processing {file_path}")
-        functions = analyzer.parser.parse_file(file_path)
-        
-        # Analyze all functions in the file concurrently
-        # analyses = await analyzer.analyze_functions(functions)
-        
-        # for func, analysis in zip(functions, analyses):
-        for func in functions:
-            # Skip if the analysis is empty
-            # if len(analysis) > 0:
-            results.append({
-                "file": file_path[42:],
-                "function": {
-                    "name": func.name,
-                    "content": func.content,
-                    "start_line": func.start_line,
-                    "end_line": func.end_line,
-                    "attributes": func.attributes,
-                    "docstring": func.docstring,
-                    "repo_url": repo_url,
-                    "program_id": program_id,
-                    "dependencies": dependencies,
-                },
-                "analysis": {} # analysis
-            })
-    
-    return results
+def function_record(file_path: str, func: RustFunction, program_id: str, repo_url: str, dependencies: List[Dict], analysis: Dict) -> Dict:
+    return {
+        "file": file_path[42:],
+        "function": {
+            "name": func.name,
+            "content": func.content,
+            "start_line": func.start_line,
+            "end_line": func.end_line,
+            "attributes": func.attributes,
+            "docstring": func.docstring,
+            "repo_url": repo_url,
+            "program_id": program_id,
+            "dependencies": dependencies,
+        },
+        "analysis": analysis
+    }
+
+
+async def iter_process_workspaces(
+    analyzer: SolanaAnalyzer,
+    workspaces: List[Tuple[List[str], List[Dict]]],
+    program_id: str,
+    repo_url: str,
+    parse_pool: Optional[ProcessPoolExecutor] = None,
+    analyze: bool = False,
+    dead_letters: Optional[DeadLetters] = None,
+    max_pending: Optional[int] = None,
+) -> AsyncIterator[Dict]:
+    """
+    Yield one result record per function of each (files, dependencies)
+    workspace, as the functions are parsed or, with analyze on, as their
+    analyses finish.
+
+    Analyses run across file and workspace boundaries: later files are parsed
+    and queued while earlier stragglers finish, with at most max_pending
+    (default twice the analyzer's largest concurrency window) functions
+    waiting on the analyzer. Failed analyses are left empty, and the function
+    goes to dead_letters if given.
+    """
+    # Which file (and workspace) each function waiting on its analysis came from
+    origins: Dict[int, Tuple[str, List[Dict]]] = {}
+
+    async def functions() -> AsyncIterator[RustFunction]:
+        for files, dependencies in workspaces:
+            async for file_path, file_functions in iter_parsed_files(analyzer.parser, files, parse_pool):
+                print(f"Processing {file_path}")
+                for func in file_functions:
+                    origins[id(func)] = (file_path, dependencies)
+                    yield func
 
+    if analyze:
+        if max_pending is None:
+            max_pending = 2 * analyzer.concurrency.max_limit
+        analyses = analyzer.iter_analyses(functions(), max_pending)
+    else:
+        analyses = ((func, {}) async for func in functions())
 
-async def analyze_repo(
+    async with contextlib.aclosing(analyses):
+        async for func, analysis in analyses:
+            file_path, dependencies = origins.pop(id(func))
+            record = function_record(file_path, func, program_id, repo_url, dependencies, analysis)
+            if "error" in analysis:
+                # Errors aren't results; they're retried from the dead-letter file
+                if dead_letters is not None:
+                    dead_letters.add(program_id, record, analysis["error"])
+                record["analysis"] = {}
+            yield record
+
+
+async def iter_process_files(
+    analyzer: SolanaAnalyzer,
+    files: List[str],
+    program_id: str,
+    repo_url: str,
+    dependencies: List[Dict],
+    parse_pool: Optional[ProcessPoolExecutor] = None,
+    analyze: bool = False,
+    dead_letters: Optional[DeadLetters] = None,
+    max_pending: Optional[int] = None,
+) -> AsyncIterator[Dict]:
+    """Yield one result record per function of `files`; see iter_process_workspaces."""
+    async with contextlib.aclosing(iter_process_workspaces(
+        analyzer, [(files, dependencies)], program_id, repo_url, parse_pool, analyze, dead_letters, max_pending
+    )) as records:
+        async for record in records:
+            yield record
+
+
+async def process_files(
+    analyzer: SolanaAnalyzer,
+    files: List[str],
+    program_id: str,
+    repo_url: str,
+    dependencies: List[Dict],
+    parse_pool: Optional[ProcessPoolExecutor] = None,
+    analyze: bool = False,
+    dead_letters: Optional[DeadLetters] = None,
+) -> List[Dict]:
+    return [
+        record
+        async for record in iter_process_files(
+            analyzer, files, program_id, repo_url, dependencies, parse_pool, analyze, dead_letters
+        )
+    ]
+
+
+def create_analyzer(
+    openai_api_key: Optional[str] = None,
+    parse_cache_dir: Optional[str] = None,
+    analysis_cache_path: Optional[str] = None,
+    long_context_model: Optional[str] = None,
+    cascade: bool = True,
+    classifier_model: Optional[str] = None,
+    hedge_ratio: float = 0.0,
+    pack_tokens: int = 0,
+    http2: bool = False
+) -> SolanaAnalyzer:
+    """Create a SolanaAnalyzer, taking the OpenAI API key from the env if not provided."""
+    if not openai_api_key:
+        openai_api_key = os.getenv("OPENAI_API_KEY")
+        if not openai_api_key:
+            raise ValueError("OpenAI API key not provided and not found in environment")
+    return SolanaAnalyzer(
+        openai_api_key,
+        parse_cache=ParseCache(parse_cache_dir) if parse_cache_dir else None,
+        analysis_cache=SqliteCache(analysis_cache_path) if analysis_cache_path else None,
+        long_context_model=long_context_model or None,
+        cascade=cascade,
+        classifier_model=classifier_model or None,
+        hedge_ratio=hedge_ratio,
+        pack_tokens=pack_tokens,
+        http2=http2,
+    )
+
+
+def print_analysis_stats(analyzer: SolanaAnalyzer):
+    print(f"Analysis stats: {dict(analyzer.stats)}")
+    if analyzer.dedupe:
+        print(f"Dedupe: {analyzer.dedupe_stats()}")
+    print(f"Token usage: {analyzer.usage_stats()}")
+    print(f"Cascade tiers: {analyzer.tier_stats()}")
+    print(f"Concurrency: {analyzer.concurrency.stats()}")
+    print(f"Latency and hedging: {analyzer.hedging.stats()}")
+    if analyzer.static_prefix_tokens < analyzer.PROMPT_CACHE_MIN_TOKENS:
+        print(f"Static prompt prefix is ~{analyzer.static_prefix_tokens} tokens, below the {analyzer.PROMPT_CACHE_MIN_TOKENS} OpenAI caches")
+    if analyzer.analysis_cache is not None:
+        print(f"Analysis cache: {analyzer.analysis_cache.stats()}")
+    # A recording ReplayBackend wraps the backend making the requests
+    backend = analyzer.backend.backend if isinstance(analyzer.backend, ReplayBackend) else analyzer.backend
+    if isinstance(backend, OpenAIBackend):
+        print(f"Connections: {backend.connection_stats.stats()}")
+
+
+async def iter_analyze_repo(
     repo_url: str,
     program_id: str,
     workspace_root: str,
     commit_hash: Optional[str] = None,
-    openai_api_key: Optional[str] = None
-) -> List[Dict]:
+    openai_api_key: Optional[str] = None,
+    parse_workers: int = 0,
+    parse_cache_dir: Optional[str] = None,
+    analyze: bool = False,
+    analysis_cache_path: Optional[str] = None,
+    analyzer: Optional[SolanaAnalyzer] = None,
+    dead_letters: Optional[DeadLetters] = None,
+    parse_pool: Optional[ProcessPoolExecutor] = None
+) -> AsyncIterator[Dict]:
     """
-    Analyze a Solana repository and return the analysis results.
+    Analyze a Solana repository, yielding each result record as it is produced.
     
     Args:
         repo_url: URL of the git repository
@@ -216,19 +2468,29 @@ async def analyze_repo(
         workspace_root: Root directory of the workspace within the repo
         commit_hash: Optional specific commit to analyze
         openai_api_key: OpenAI API key. If not provided, will try to get from env
+        parse_workers: Number of processes to parse files with, if no parse_pool is given. 0 parses in-process
+        parse_cache_dir: Directory of the parse cache. If not provided, every file is parsed
+        analyze: Whether to analyze each function with OpenAI
+        analysis_cache_path: SQLite file caching analyses across runs. If not provided, nothing is cached
+        analyzer: Analyzer to reuse across repos, so identical functions are only analyzed once.
+            If provided, openai_api_key and the cache options are ignored
+        dead_letters: Where to record functions whose analysis failed, for replay_dead_letters
+        parse_pool: Pool from create_parse_pool to reuse across repos. It is left running
     
-    Returns:
-        List of dictionaries containing the analysis results
+    Yields:
+        One dictionary per function containing its analysis result
     """
-    if not openai_api_key:
-        openai_api_key = os.getenv("OPENAI_API_KEY")
-        if not openai_api_key:
-            raise ValueError("OpenAI API key not provided and not found in environment")
+    if analyzer is None:
+        analyzer = create_analyzer(openai_api_key, parse_cache_dir, analysis_cache_path)
 
     # Create temp directory with UUID
     tmp_uuid = str(uuid.uuid4())
     tmp_dir = f"/tmp/{tmp_uuid}"
     print(f"Using temporary directory: {tmp_uuid}")
+    parse_cache = analyzer.parser.cache
+    own_parse_pool = parse_pool is None and parse_workers > 0
+    if own_parse_pool:
+        parse_pool = create_parse_pool(parse_workers, parse_cache and parse_cache.cache_dir)
     
     try:
         # Clone repo
@@ -236,7 +2498,7 @@ async def analyze_repo(
             repo = git.Repo.clone_from(repo_url, tmp_dir)
         except Exception as e:
             print(f"Error cloning repo, skipping {repo_url}: {e}")
-            return []
+            return
 
         if commit_hash is not None and len(commit_hash) > 0 and commit_hash.lower() != "none":
             print(f"Checking out commit {commit_hash}")
@@ -246,10 +2508,8 @@ async def analyze_repo(
         repo_root = Path(tmp_dir).joinpath(Path(workspace_root))
         print(tmp_dir, workspace_root, repo_root)
         
-        analyzer = SolanaAnalyzer(openai_api_key)
-        
         # Find all Cargo workspaces
-        results = []
+        workspaces = []
         for root, dirs, files in os.walk(repo_root):
             if 'Cargo.toml' in files:
                 # Check if src exists in this dir or any subdirs
@@ -271,7 +2531,6 @@ async def analyze_repo(
                             if file.endswith('.rs')
                         ]
 
-                    # Process all files
                     dependencies = []
                     if os.path.exists(os.path.join(root, "Cargo.toml")):
                         cargo_toml = toml.load(os.path.join(root, "Cargo.toml"))
@@ -282,17 +2541,70 @@ async def analyze_repo(
                         print(root, dirs, files)
                         raise ValueError("No Cargo.toml found")
 
-                    root_results = await process_files(analyzer, rust_files, program_id, repo_url, dependencies)
-                    results.extend(root_results)
+                    workspaces.append((rust_files, dependencies))
+
+        # Process all files, with analyses overlapping across files and workspaces
+        async with contextlib.aclosing(iter_process_workspaces(
+            analyzer, workspaces, program_id, repo_url, parse_pool, analyze, dead_letters
+        )) as records:
+            async for record in records:
+                yield record
         
-        return results
+        if analyze:
+            print_analysis_stats(analyzer)
     
     finally:
+        if own_parse_pool:
+            parse_pool.shutdown()
+
         # Cleanup temp directory
         if os.path.exists(tmp_dir):
             shutil.rmtree(tmp_dir)
 
 
+async def analyze_repo(repo_url: str, program_id: str, workspace_root: str, **kwargs) -> List[Dict]:
+    """
+    Analyze a Solana repository and return the analysis results.
+
+    Takes the same arguments as iter_analyze_repo, which streams the records
+    instead of holding the whole repository's results in memory.
+    """
+    async with contextlib.aclosing(iter_analyze_repo(repo_url, program_id, workspace_root, **kwargs)) as records:
+        return [record async for record in records]
+
+
+async def stream_results_as_jsonl(records: AsyncIterator[Dict], program_id: str) -> int:
+    """
+    Write result records to jsonl/<program_id>.jsonl as they are produced.
+
+    Records go to a temporary file that replaces the JSONL only once every
+    record is written, so an interrupted run never leaves a partial file
+    behind for the next run to mistake for a finished program. Unlike
+    save_results_as_jsonl, no indented JSON copy is written, since that would
+    need every record in memory at once.
+
+    Returns:
+        Number of functions saved
+    """
+    jsonl_output_path = f"jsonl/{program_id}.jsonl"
+    tmp_path = f"{jsonl_output_path}.tmp"
+    count = 0
+    try:
+        async with contextlib.aclosing(records):
+            with open(tmp_path, 'w') as jsonl_file:
+                async for item in records:
+                    json.dump(item, jsonl_file)
+                    jsonl_file.write('\n')
+                    count += 1
+        os.replace(tmp_path, jsonl_output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    print(f"Streamed {count} functions to {jsonl_output_path}")
+    return count
+
+
 def save_results_as_jsonl(results: List[Dict], program_id: str) -> int:
     """
     Save analysis results as both JSON and JSONL files.
@@ -325,6 +2637,69 @@ def save_results_as_jsonl(results: List[Dict], program_id: str) -> int:
     
     return count
 
+def save_embeddings(vectors: np.ndarray, program_id: str) -> str:
+    """Save a program's function vectors next to its JSONL, row i for line i."""
+    output_path = f"jsonl/{program_id}.embeddings.npy"
+    np.save(output_path, vectors.astype(np.float32, copy=False))
+    print(f"Saved {vectors.shape[0]} embeddings to {output_path}")
+    return output_path
+
+async def embed_saved_program(embedder: "FunctionEmbedder", program_id: str) -> bool:
+    """
+    Embed a program saved by an earlier run, unless it already has embeddings.
+    Returns whether it was embedded.
+    """
+    if os.path.exists(f"jsonl/{program_id}.embeddings.npy") or not os.path.exists(f"jsonl/{program_id}.jsonl"):
+        return False
+    save_embeddings(await embedder.embed_records(load_results_jsonl(program_id)), program_id)
+    return True
+
+def load_results_jsonl(program_id: str) -> List[Dict]:
+    """Load results saved by save_results_as_jsonl."""
+    with open(f"jsonl/{program_id}.jsonl", 'r') as jsonl_file:
+        return [json.loads(line) for line in jsonl_file if line.strip()]
+
+def load_result_line(program_id: str, line: int) -> Dict:
+    """Load one record saved by save_results_as_jsonl."""
+    with open(f"jsonl/{program_id}.jsonl", 'r') as jsonl_file:
+        return json.loads(next(itertools.islice(jsonl_file, line, None)))
+
+async def replay_dead_letters(analyzer: SolanaAnalyzer, dead_letters: DeadLetters) -> int:
+    """
+    Analyze the dead-lettered functions again and merge the analyses that
+    succeed into their programs' saved results. Functions that fail again
+    stay in the dead-letter file. Returns how many functions were recovered.
+    """
+    entries = dead_letters.load()
+    fingerprints = [analyzer.parser.fingerprint(function_from_record(entry)) for entry in entries]
+    functions = {}
+    for fingerprint, entry in zip(fingerprints, entries):
+        functions.setdefault(fingerprint, function_from_record(entry))
+    print(f"Replaying {len(functions)} dead-lettered functions from {dead_letters.path}")
+
+    results = {}
+    async for function, analysis in analyzer.iter_analyses(list(functions.values())):
+        results[analyzer.parser.fingerprint(function)] = analysis
+    recovered = {fingerprint: analysis for fingerprint, analysis in results.items() if "error" not in analysis}
+
+    for program_id in sorted({entry["program_id"] for entry in entries}):
+        if not os.path.exists(f"jsonl/{program_id}.jsonl"):
+            # Never saved, so the next run analyzes the whole program (from the analysis cache where it can)
+            continue
+        records = load_results_jsonl(program_id)
+        merged = merge_analyses(analyzer, records, recovered, program_id)
+        save_results_as_jsonl(records, program_id)
+        print(f"Merged {merged} replayed analyses into {program_id}")
+
+    remaining = []
+    for fingerprint, entry in zip(fingerprints, entries):
+        if fingerprint not in recovered:
+            entry["error"] = results[fingerprint]["error"]
+            remaining.append(entry)
+    dead_letters.rewrite(remaining)
+    print(f"Recovered {len(recovered)} functions, {len(functions) - len(recovered)} still failing")
+    return len(recovered)
+
 @dataclass
 class OtterVerifyBuildParams:
     address: str
@@ -414,9 +2789,29 @@ def deserialize_account_data(data: bytes) -> OtterVerifyBuildParams:
 async def main():
     # Load environment variables
     load_dotenv()
-    
-    # Configuration
-    accounts = await find_explorer_pdas(Pubkey.from_string("CyJj5ejJAUveDXnLduJbkvwjxcmWJNqCuB9DR7AExrHn"))
+
+    parser = argparse.ArgumentParser(description="Index the verified Solana programs uploaded by a signer")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("analyze", help="analyze every program (the default)")
+    subparsers.add_parser("replay-dead-letters", help="retry only the functions whose analysis failed")
+    subparsers.add_parser("embed", help="embed every saved program that has no embeddings yet")
+    index_parser = subparsers.add_parser("build-index", help="build the vector index from the saved embeddings")
+    index_parser.add_argument("--quantize", action="store_true", help="store int8 vectors, a quarter of the size")
+    search_parser = subparsers.add_parser("search", help="semantic search over the vector index")
+    search_parser.add_argument("query")
+    search_parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+    index_dir = os.getenv("VECTOR_INDEX_DIR", ".cache/index")
+    embedding_model = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+    if args.command == "build-index":
+        program_ids = sorted(path.name[:-len(".embeddings.npy")] for path in Path("jsonl").glob("*.embeddings.npy"))
+        index = VectorIndex.build(
+            index_dir, program_ids, quantize=args.quantize,
+            embedding_backend=OpenAIEmbeddings.backend_name(embedding_model),
+        )
+        print(f"Indexed {len(index)} functions from {len(program_ids)} programs into {index_dir}")
+        return
 
     # results = await analyze_repo(
     #     repo_url="https://github.com/drift-labs/protocol-v2.git",
@@ -425,36 +2820,126 @@ async def main():
     #     commit_hash="e2191dfc09cc1783618238b1cd22a7015b3085a6"
     # )
 
-    seen_repos = set()  
-    for account in accounts:
-        program_id = account.address
-        repo_url = account.git_url
-        workspace_root = "./"
-        commit_hash = account.commit if len(account.commit) > 0 else None
-
-        library_name = None
-        for (i, arg) in enumerate(account.args):
-            if arg.startswith("--library-name"):
-                library_name = account.args[i+1]
-                break
-
-        if repo_url in seen_repos or (os.path.exists(f"jsonl/{program_id}.jsonl")):
-            print(f"Skipping {repo_url} because it has already been seen")
-            continue
-        seen_repos.add(repo_url)
-        # Go through args and find --library-name, and use next item as workspace root
-
-        print(f"Analyzing {program_id} from {repo_url} with commit {commit_hash} @ {library_name}\n")
-        if not all([repo_url, program_id, workspace_root]):
-            raise ValueError("Missing required environment variables")
-
-        results = await analyze_repo(
-            repo_url=repo_url,
-            program_id=program_id,
-            workspace_root=workspace_root,
-            commit_hash=commit_hash
+    # One analyzer for every repo, so forks only pay for functions they changed
+    analysis_mode = os.getenv("ANALYZE_FUNCTIONS", "0")
+    analyze = analysis_mode == "1"
+    analyzer = create_analyzer(
+        parse_cache_dir=os.getenv("PARSE_CACHE_DIR", ".cache/parse"),
+        analysis_cache_path=os.getenv("ANALYSIS_CACHE_PATH", ".cache/analysis.sqlite"),
+        long_context_model=os.getenv("LONG_CONTEXT_MODEL"),
+        cascade=os.getenv("ANALYSIS_CASCADE", "1") == "1",
+        classifier_model=os.getenv("CLASSIFIER_MODEL"),
+        hedge_ratio=float(os.getenv("HEDGE_RATIO", "0")),
+        pack_tokens=int(os.getenv("PACK_TOKENS", "0")),
+        http2=os.getenv("OPENAI_HTTP2", "0") == "1"
+    )
+    dead_letters = DeadLetters(os.getenv("DEAD_LETTER_PATH", ".cache/dead_letters.jsonl"))
+    embedder = None
+    if os.getenv("EMBED_FUNCTIONS", "0") == "1" or args.command in ("embed", "search"):
+        embeddings_cache_path = os.getenv("EMBEDDINGS_CACHE_PATH", ".cache/embeddings.sqlite")
+        embedder = FunctionEmbedder(
+            OpenAIEmbeddings(analyzer.backend.client, embedding_model),
+            cache=SqliteCache(embeddings_cache_path, max_bytes=4 * 1024 * 1024 * 1024) if embeddings_cache_path else None,
         )
-        save_results_as_jsonl(results, program_id)
+
+    if args.command == "replay-dead-letters":
+        await replay_dead_letters(analyzer, dead_letters)
+        print_analysis_stats(analyzer)
+        return
+
+    if args.command == "embed":
+        program_ids = sorted(path.name[:-len(".jsonl")] for path in Path("jsonl").glob("*.jsonl"))
+        embedded = [program_id for program_id in program_ids if await embed_saved_program(embedder, program_id)]
+        print(f"Embedded {len(embedded)} of {len(program_ids)} saved programs. Embedding stats: {dict(embedder.stats)}")
+        return
+
+    if args.command == "search":
+        # Queries must be embedded with the same model as the functions
+        index = VectorIndex(index_dir)
+        if index.embedding_backend != embedder.backend.name:
+            raise SystemExit(
+                f"{index_dir} was built with {index.embedding_backend or 'an unrecorded embedding model'}, "
+                f"but queries would be embedded with {embedder.backend.name}. "
+                f"Set EMBEDDING_MODEL to match, or re-embed and run build-index again."
+            )
+        query = await embedder.backend.embed([args.query])
+        for program_id, line, score in index.search(query, args.k)[0]:
+            record = load_result_line(program_id, line)
+            print(f"{score:.3f}  {record['function']['name']}  {record['function']['repo_url']} {record['file']}:{record['function']['start_line']}")
+        return
+
+    # Configuration
+    accounts = await find_explorer_pdas(Pubkey.from_string("CyJj5ejJAUveDXnLduJbkvwjxcmWJNqCuB9DR7AExrHn"))
+
+    batch_runner = BatchRunner(analyzer, dead_letters=dead_letters) if analysis_mode == "batch" else None
+
+    # One pool for every repo, so workers (and their parse caches) start once
+    parse_workers = int(os.getenv("PARSE_WORKERS", "0"))
+    parse_cache = analyzer.parser.cache
+    parse_pool = create_parse_pool(parse_workers, parse_cache and parse_cache.cache_dir) if parse_workers > 0 else None
+
+    try:
+        seen_repos = set()
+        for account in accounts:
+            program_id = account.address
+            repo_url = account.git_url
+            workspace_root = "./"
+            commit_hash = account.commit if len(account.commit) > 0 else None
+
+            library_name = None
+            for (i, arg) in enumerate(account.args):
+                if arg.startswith("--library-name"):
+                    library_name = account.args[i+1]
+                    break
+
+            if repo_url in seen_repos or (os.path.exists(f"jsonl/{program_id}.jsonl")):
+                print(f"Skipping {repo_url} because it has already been seen")
+                # Programs saved before EMBED_FUNCTIONS was turned on still get embedded
+                if embedder is not None:
+                    await embed_saved_program(embedder, program_id)
+                continue
+            seen_repos.add(repo_url)
+            # Go through args and find --library-name, and use next item as workspace root
+
+            print(f"Analyzing {program_id} from {repo_url} with commit {commit_hash} @ {library_name}\n")
+            if not all([repo_url, program_id, workspace_root]):
+                raise ValueError("Missing required environment variables")
+
+            records = iter_analyze_repo(
+                repo_url=repo_url,
+                program_id=program_id,
+                workspace_root=workspace_root,
+                commit_hash=commit_hash,
+                parse_pool=parse_pool,
+                analyze=analyze,
+                analyzer=analyzer,
+                dead_letters=dead_letters
+            )
+            if batch_runner is not None:
+                # Before the JSONL exists, so a run that dies before submitting still submits on resume
+                batch_runner.begin(program_id)
+            await stream_results_as_jsonl(records, program_id)
+            # A batch and the embeddings each need the whole program at once, so they read it back
+            if batch_runner is not None:
+                results = load_results_jsonl(program_id)
+                await batch_runner.submit(program_id, results)
+                save_results_as_jsonl(results, program_id)
+            if embedder is not None:
+                save_embeddings(await embedder.embed_records(load_results_jsonl(program_id)), program_id)
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+
+    if batch_runner is not None:
+        # Also resumes batches from earlier runs, wherever they stopped
+        await batch_runner.complete_all()
+
+    if analyze or batch_runner is not None:
+        print_analysis_stats(analyzer)
+    if embedder is not None:
+        print(f"Embedding stats: {dict(embedder.stats)}")
+    if dead_letters.added:
+        print(f"{dead_letters.added} failed analyses written to {dead_letters.path}; retry them with `main.py replay-dead-letters`")
 
 if __name__ == "__main__":
     asyncio.run(main())
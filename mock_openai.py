@@ -0,0 +1,409 @@
+"""
+Local stand-in for the parts of the OpenAI API Spyglass uses: chat
+completions, file uploads and the Batch API.
+
+Completions always call the first tool offered, with canned arguments, so
+the pipeline can be exercised without paying for real calls. Latency, server
+errors and rate limiting can be simulated for load tests:
+
+    uv run mock_openai.py --port 8787 --latency 0.5 --error-rate 0.01 --requests-per-minute 500
+    OPENAI_BASE_URL=http://127.0.0.1:8787/v1 OPENAI_API_KEY=mock uv run main.py
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from array import array
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+def prompt_prefix(body: Dict) -> str:
+    """The part of a request OpenAI can cache across requests: tools, then the leading system messages."""
+    prefix = [json.dumps(body.get("tools", []))]
+    for message in body.get("messages", []):
+        if message.get("role") != "system":
+            break
+        prefix.append(str(message.get("content") or ""))
+    return "".join(prefix)
+
+
+def mock_completion(body: Dict, cached_tokens: int = 0) -> Dict:
+    """
+    A chat completion that calls the first tool in the request. Tools taking
+    a `results` array get one result per "Function N:" in the prompt.
+    """
+    tool = body["tools"][0]["function"] if body.get("tools") else None
+    message = {"role": "assistant", "content": None}
+    if tool is None:
+        message["content"] = "Mock response"
+    else:
+        arguments = {"category": "cpi", "description": "Mock analysis"}
+        if "results" in tool.get("parameters", {}).get("properties", {}):
+            prompt = "\n".join(str(m.get("content") or "") for m in body.get("messages", []))
+            indexes = [int(index) for index in re.findall(r"^Function (\d+):", prompt, re.MULTILINE)]
+            arguments = {"results": [{"index": index, **arguments} for index in indexes]}
+        message["tool_calls"] = [{
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": tool["name"], "arguments": json.dumps(arguments)},
+        }]
+    prompt_chars = sum(len(str(m.get("content") or "")) for m in body.get("messages", []))
+    prompt_tokens = (prompt_chars + len(json.dumps(body.get("tools", [])))) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool else "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": 20,
+            "total_tokens": prompt_tokens + 20,
+            "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)},
+        },
+    }
+
+
+def mock_embeddings(body: Dict) -> Dict:
+    """Embeddings that are random but fixed per input text, as floats or base64 float32."""
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    dimensions = body.get("dimensions") or 256
+    data = []
+    for index, text in enumerate(texts):
+        rng = random.Random(hashlib.sha256(str(text).encode()).digest())
+        vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+        norm = sum(value * value for value in vector) ** 0.5
+        vector = [value / norm for value in vector]
+        if body.get("encoding_format") == "base64":
+            vector = base64.b64encode(array("f", vector).tobytes()).decode()
+        data.append({"object": "embedding", "index": index, "embedding": vector})
+    tokens = sum(len(str(text)) for text in texts) // 4
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "mock"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+class MockOpenAI:
+    """
+    Files, batches and simulated failures shared by every request handler.
+
+    Prompt caching works like OpenAI's: once a request's prefix (tools and
+    system prompt) has been seen, later requests starting with it get its
+    tokens reported as cached, in 128-token steps from 1024 tokens up.
+
+    Each chat completion takes `latency` seconds, give or take `jitter`, and
+    a share `slow_rate` of them take `slow_latency` instead, for a long tail. A
+    share `error_rate` of them fail with a 500 and a share `rate_limit_rate`
+    with a 429. With requests_per_minute set, requests beyond that rate also
+    get a 429, with retry-after-ms and x-ratelimit-* headers like the real API.
+    """
+
+    def __init__(
+        self,
+        batch_delay: float = 1.0,
+        batch_status: str = "completed",
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_latency: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        requests_per_minute: int = 0,
+        seed: Optional[int] = None,
+    ):
+        # Batches stay in_progress for batch_delay seconds before finishing as
+        # batch_status; any status but completed leaves them without output
+        self.batch_delay = batch_delay
+        self.batch_status = batch_status
+        self.latency = latency
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests_per_minute = requests_per_minute
+        self.random = random.Random(seed)
+        self.prefixes = set()
+        self.request_budget = float(requests_per_minute)
+        self.budget_updated = time.monotonic()
+        self.files: Dict[str, Dict] = {}
+        self.file_contents: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+
+    def admit(self) -> Tuple[int, Dict[str, str], float]:
+        """Decide a chat completion's fate: (status, headers to send, seconds to wait first)."""
+        headers = {}
+        with self.lock:
+            roll = self.random.random()
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            if self.random.random() < self.slow_rate:
+                delay = self.slow_latency
+            if self.requests_per_minute:
+                now = time.monotonic()
+                self.request_budget = min(
+                    self.requests_per_minute,
+                    self.request_budget + (now - self.budget_updated) * self.requests_per_minute / 60,
+                )
+                self.budget_updated = now
+                if self.request_budget < 1:
+                    wait_ms = int((1 - self.request_budget) * 60_000 / self.requests_per_minute) + 1
+                    return 429, {
+                        "retry-after-ms": str(wait_ms),
+                        "x-ratelimit-limit-requests": str(self.requests_per_minute),
+                        "x-ratelimit-remaining-requests": "0",
+                        "x-ratelimit-reset-requests": f"{wait_ms}ms",
+                    }, 0.0
+                self.request_budget -= 1
+                headers = {
+                    "x-ratelimit-limit-requests": str(self.requests_per_minute),
+                    "x-ratelimit-remaining-requests": str(int(self.request_budget)),
+                }
+        if roll < self.rate_limit_rate:
+            return 429, {"retry-after-ms": "100"}, 0.0
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 500, headers, delay
+        return 200, headers, delay
+
+    def cached_tokens(self, body: Dict) -> int:
+        prefix = prompt_prefix(body)
+        tokens = len(prefix) // 4
+        with self.lock:
+            seen = prefix in self.prefixes
+            self.prefixes.add(prefix)
+        if not seen or tokens < 1024:
+            return 0
+        return tokens - tokens % 128
+
+    def create_file(self, content: bytes, purpose: str, filename: str) -> Dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        file = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self.lock:
+            self.files[file_id] = file
+            self.file_contents[file_id] = content
+        return file
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> Dict:
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "in_progress_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        return batch
+
+    def list_batches(self) -> List[Dict]:
+        """Every batch, newest first, like GET /v1/batches."""
+        with self.lock:
+            batch_ids = list(self.batches)
+        return [self.get_batch(batch_id) for batch_id in reversed(batch_ids)]
+
+    def get_batch(self, batch_id: str) -> Optional[Dict]:
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None or batch["status"] != "in_progress":
+                return batch
+            if time.time() - batch["created_at"] < self.batch_delay:
+                return batch
+            if self.batch_status != "completed":
+                batch.update({"status": self.batch_status, f"{self.batch_status}_at": int(time.time())})
+                return batch
+            input_lines = self.file_contents[batch["input_file_id"]].decode().splitlines()
+
+        output_lines = []
+        for line in input_lines:
+            request = json.loads(line)
+            output_lines.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": mock_completion(request["body"], self.cached_tokens(request["body"]))},
+                "error": None,
+            }))
+        output = self.create_file("\n".join(output_lines).encode(), "batch_output", f"{batch_id}_output.jsonl")
+
+        with self.lock:
+            batch.update({
+                "status": "completed",
+                "completed_at": int(time.time()),
+                "output_file_id": output["id"],
+                "request_counts": {"total": len(output_lines), "completed": len(output_lines), "failed": 0},
+            })
+            return batch
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def api(self) -> MockOpenAI:
+        return self.server.api
+
+    def send_json(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def not_found(self):
+        self.send_json(404, {"error": {"message": f"No route for {self.command} {self.path}", "type": "invalid_request_error"}})
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == "/v1/chat/completions":
+            status, headers, delay = self.api.admit()
+            time.sleep(delay)
+            if status == 429:
+                self.send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}}, headers)
+            elif status == 500:
+                self.send_json(500, {"error": {"message": "Simulated server error (mock)", "type": "server_error"}}, headers)
+            else:
+                request = json.loads(body)
+                self.send_json(200, mock_completion(request, self.api.cached_tokens(request)), headers)
+        elif self.path == "/v1/embeddings":
+            self.send_json(200, mock_embeddings(json.loads(body)))
+        elif self.path == "/v1/files":
+            # Multipart upload with `purpose` and `file` fields
+            message = BytesParser().parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+            )
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+            self.send_json(200, self.api.create_file(
+                fields["file"].get_payload(decode=True),
+                fields["purpose"].get_payload(decode=True).decode(),
+                fields["file"].get_filename() or "upload.jsonl",
+            ))
+        elif self.path == "/v1/batches":
+            request = json.loads(body)
+            self.send_json(200, self.api.create_batch(request["input_file_id"], request["endpoint"], request["completion_window"]))
+        else:
+            self.not_found()
+
+    def do_GET(self):
+        parts = urlsplit(self.path).path.strip("/").split("/")
+        if parts == ["v1", "batches"]:
+            # One page with everything, so `after` and `limit` are ignored
+            batches = self.api.list_batches()
+            self.send_json(200, {
+                "object": "list",
+                "data": batches,
+                "first_id": batches[0]["id"] if batches else None,
+                "last_id": batches[-1]["id"] if batches else None,
+                "has_more": False,
+            })
+        elif parts[:2] == ["v1", "batches"] and len(parts) == 3:
+            batch = self.api.get_batch(parts[2])
+            self.send_json(200, batch) if batch else self.not_found()
+        elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+            content = self.api.file_contents.get(parts[2])
+            if content is None:
+                return self.not_found()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.not_found()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on purpose, e.g. when a hedged request loses
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def create_server(host: str = "127.0.0.1", port: int = 0, **options) -> ThreadingHTTPServer:
+    """Create a mock server; port 0 picks a free port (see server.server_address)."""
+    server = MockServer((host, port), MockHandler)
+    server.api = MockOpenAI(**options)
+    return server
+
+
+def start_server(**options) -> ThreadingHTTPServer:
+    """Start a mock server on a background thread, e.g. for tests and benchmarks."""
+    server = create_server(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="seconds a batch stays in_progress")
+    parser.add_argument(
+        "--batch-status", default="completed", choices=["completed", "failed", "expired", "cancelled"],
+        help="how batches finish; anything but completed leaves them without output",
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each chat completion takes")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds added to the latency")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of completions taking --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=0.0, help="seconds the slow completions take")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of completions failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of completions failing with a 429")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="429 requests beyond this rate (0 = unlimited)")
+    parser.add_argument("--seed", type=int, help="seed for the simulated latency and failures")
+    args = parser.parse_args()
+
+    server = create_server(
+        args.host, args.port,
+        batch_delay=args.batch_delay,
+        batch_status=args.batch_status,
+        latency=args.latency,
+        jitter=args.jitter,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        requests_per_minute=args.requests_per_minute,
+        seed=args.seed,
+    )
+    print(f"Mock OpenAI API listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+AdaptiveConcurrency's AIMD window.
+
+Run with `uv run python -m unittest discover tests`.
+"""
+import time
+import unittest
+
+from main import AdaptiveConcurrency
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+    def test_burst_before_any_success_halves_once(self):
+        concurrency = AdaptiveConcurrency(16)
+        for _ in range(8):
+            concurrency.overloaded(0.05)
+        self.assertEqual(concurrency.limit, 8)
+
+    def test_requests_sent_after_a_decrease_count_again(self):
+        concurrency = AdaptiveConcurrency(16)
+        concurrency.overloaded(0.05)
+        time.sleep(0.01)
+        concurrency.overloaded(0.001)
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_never_below_min_limit(self):
+        concurrency = AdaptiveConcurrency(2, min_limit=2)
+        concurrency.overloaded(0.0)
+        self.assertEqual(concurrency.limit, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+BatchRunner submit -> poll -> merge against the mock OpenAI server.
+
+Run with `uv run python -m unittest discover tests`.
+"""
+import json
+import os
+import tempfile
+import unittest
+
+import mock_openai
+from main import BatchRunner, DeadLetters, OpenAIBackend, RustFunction, SolanaAnalyzer, load_results_jsonl, save_results_as_jsonl
+
+
+def make_record(i: int) -> dict:
+    function = RustFunction.from_text(
+        f"transfer_{i}",
+        f"pub fn transfer_{i}(ctx: Context<Transfer>, amount: u64) -> Result<()> {{\n"
+        f"    token::transfer(ctx.accounts.transfer_ctx(), amount + {i})\n"
+        f"}}",
+        1, 3, [], None,
+    )
+    return {
+        "file": "src/lib.rs",
+        "function": {
+            "name": function.name,
+            "content": function.content,
+            "start_line": function.start_line,
+            "end_line": function.end_line,
+            "attributes": function.attributes,
+            "docstring": function.docstring,
+            "repo_url": "https://example.com/program.git",
+            "program_id": "program",
+            "dependencies": {},
+        },
+        "analysis": {},
+    }
+
+
+class BatchRunnerTest(unittest.IsolatedAsyncioTestCase):
+    def start_mock(self, **options):
+        server = mock_openai.start_server(batch_delay=0.2, **options)
+        self.addCleanup(server.shutdown)
+        self.mock = server.api
+        host, port = server.server_address
+        return OpenAIBackend("mock", base_url=f"http://{host}:{port}/v1")
+
+    def assert_merged(self, runner: BatchRunner):
+        self.assertEqual(runner.pending(), [])
+        records = load_results_jsonl("program")
+        self.assertEqual(len(records), 3)
+        self.assertTrue(all(record["analysis"] for record in records))
+        self.assertEqual(self.dead_letters.load(), [])
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        # Results are saved to and merged into ./jsonl
+        os.chdir(tmp_dir.name)
+        os.mkdir("jsonl")
+        self.dead_letters = DeadLetters(os.path.join(tmp_dir.name, "dead_letters.jsonl"))
+        self.records = [make_record(i) for i in range(3)]
+        save_results_as_jsonl(self.records, "program")
+
+    def runner(self, backend: OpenAIBackend) -> BatchRunner:
+        analyzer = SolanaAnalyzer("mock", backend=backend, static_classifier=False)
+        return BatchRunner(analyzer, state_dir="batches", poll_interval=0.1, dead_letters=self.dead_letters)
+
+    async def test_submit_poll_merge(self):
+        runner = self.runner(self.start_mock())
+        self.assertIsNotNone(await runner.submit("program", self.records))
+        self.assertEqual(runner.pending(), ["program"])
+
+        await runner.complete_all()
+
+        self.assert_merged(runner)
+
+    async def test_resume_after_dying_before_submit(self):
+        backend = self.start_mock()
+        # Results were saved for a batch, but the run died before uploading anything
+        self.runner(backend).begin("program")
+
+        runner = self.runner(backend)
+        await runner.complete_all()
+
+        self.assert_merged(runner)
+        self.assertEqual(len(self.mock.batches), 1)
+
+    async def test_resume_after_dying_before_recording_the_batch(self):
+        backend = self.start_mock()
+        runner = self.runner(backend)
+        create = runner.client.batches.create
+
+        async def create_then_die(**kwargs):
+            await create(**kwargs)
+            raise RuntimeError("died before recording the batch")
+
+        runner.client.batches.create = create_then_die
+        with self.assertRaises(RuntimeError):
+            await runner.submit("program", self.records)
+        runner.client.batches.create = create
+        self.assertNotIn("batch_id", json.loads(runner.state_path("program").read_text()))
+
+        runner = self.runner(backend)
+        await runner.complete_all()
+
+        self.assert_merged(runner)
+        # The orphaned batch was adopted, not paid for twice
+        self.assertEqual(len(self.mock.batches), 1)
+
+    async def test_batch_without_output_is_dead_lettered(self):
+        runner = self.runner(self.start_mock(batch_status="expired"))
+        await runner.submit("program", self.records)
+        state = json.loads(runner.state_path("program").read_text())
+        self.assertEqual(len(state["custom_ids"]), 3)
+
+        await runner.complete_all()
+
+        self.assertEqual(runner.pending(), [])
+        self.assertTrue(all(not record["analysis"] for record in load_results_jsonl("program")))
+        entries = self.dead_letters.load()
+        self.assertEqual(sorted(entry["function"]["name"] for entry in entries), ["transfer_0", "transfer_1", "transfer_2"])
+        self.assertTrue(all("expired" in entry["error"] for entry in entries))
+
+
+if __name__ == "__main__":
+    unittest.main()
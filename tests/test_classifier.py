@@ -0,0 +1,72 @@
+"""
+RustParser.classify, which decides which functions never reach the model.
+
+Run with `uv run python -m unittest discover tests`.
+"""
+import unittest
+
+from main import RustFunction, RustParser
+
+
+def classify(content: str, attributes=()) -> tuple:
+    name = content.split("fn ", 1)[1].split("(", 1)[0]
+    return RustParser().classify(RustFunction.from_text(name, content, 1, 1, list(attributes), None))
+
+
+class ClassifierTest(unittest.TestCase):
+    def test_token_cpi_wrapper_is_not_irrelevant(self):
+        category, evidence = classify("fn f(ctx: Context<X>) { token::transfer(ctx.accounts.into(), 5)?; }")
+        self.assertEqual(category, "ambiguous")
+        self.assertIn("token", evidence)
+
+    def test_cpi_helper_without_context_is_not_irrelevant(self):
+        category, evidence = classify("fn f(&self, amt: u64) -> Result<()> { token::mint_to(self.mint_ctx(), amt) }")
+        self.assertEqual(category, "ambiguous")
+        self.assertIn("token", evidence)
+
+    def test_own_name_is_not_evidence(self):
+        self.assertEqual(classify("fn invoke() {}"), ("irrelevant", []))
+
+    def test_constructor_only_is_irrelevant(self):
+        self.assertEqual(classify("fn g(a: u64) -> Result<u64> { Ok(a + 1) }"), ("irrelevant", []))
+        self.assertEqual(classify("fn g() -> Result<()> { Err(Error::Custom(1)) }"), ("irrelevant", []))
+
+    def test_method_call_is_ambiguous(self):
+        category, evidence = classify("fn h(a: u64) -> u64 { a.checked_add(1).unwrap() }")
+        self.assertEqual(category, "ambiguous")
+        self.assertIn("checked_add", evidence)
+
+    def test_context_parameter_is_ambiguous(self):
+        self.assertEqual(
+            classify("fn h(ctx: Context<Foo>) -> Result<()> { msg!(\"x\"); Ok(()) }"),
+            ("ambiguous", ["Context"]),
+        )
+
+    def test_cpi_context_is_cpi(self):
+        category, evidence = classify(
+            "fn f(program: AccountInfo, accounts: Transfer) -> Result<()> {\n"
+            "    let cpi_ctx = CpiContext::new(program, accounts);\n"
+            "    Ok(())\n"
+            "}"
+        )
+        self.assertEqual(category, "cpi")
+        self.assertEqual(evidence, ["CpiContext"])
+
+    def test_invoke_signed_is_cpi(self):
+        category, evidence = classify("fn f(ix: &Instruction) { invoke_signed(ix, &[], &[]).unwrap(); }")
+        self.assertEqual((category, evidence), ("cpi", ["invoke_signed"]))
+
+    def test_find_program_address_is_derivation(self):
+        category, evidence = classify("fn f(p: &Pubkey) { Pubkey::find_program_address(&[b\"vault\"], p); }")
+        self.assertEqual((category, evidence), ("account_derivation", ["find_program_address"]))
+
+    def test_seeds_constraint_is_derivation(self):
+        category, evidence = classify(
+            "fn vault() {}",
+            attributes=["#[account(seeds = [b\"vault\"], bump)]"],
+        )
+        self.assertEqual((category, evidence), ("account_derivation", ["seeds constraint"]))
+
+
+if __name__ == "__main__":
+    unittest.main()